@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+"""
+Import time of netatmo.py per CLI mode, measured with python -X importtime in
+fresh interpreters. Each mode imports what it needs on top of netatmo.py and must
+stay under its budget (milliseconds, best of --repeat runs) without loading the
+modules reserved to other modes. Exits 1 when a mode is over budget or loads a
+forbidden module.
+
+    python3 benchmarks/bench_importtime.py
+    python3 benchmarks/bench_importtime.py --repeat 10 --budget oneshot=150
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+
+# mode -> (code run by the mode at startup, budget ms, modules it must not load)
+MODES = {
+    "oneshot": ("import netatmo", 250,
+                ["fastapi", "uvicorn", "aiohttp", "apscheduler", "jinja2", "lxml", "asyncio", "paho", "prometheus_client", "sqlite3"]),
+    "openhab": ("import netatmo; from netatmo_api import AsyncNetatmoAPI; import openhab, jinja2", 450,
+                ["fastapi", "uvicorn", "apscheduler", "lxml"]),
+    "daemon": ("import netatmo; from netatmo_api import AsyncNetatmoAPI; from apscheduler.schedulers.background import BackgroundScheduler", 500,
+               ["fastapi", "uvicorn", "jinja2", "lxml"]),
+    "webserver": ("import netatmo; from netatmo_api import AsyncNetatmoAPI; from apscheduler.schedulers.background import BackgroundScheduler; from web import launch_fastapp", 1200,
+                  ["jinja2", "lxml"]),
+}
+
+def run_importtime(code: str):
+    # {module: cumulative microseconds} of the top level imports, and every imported module
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=SRC_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    top_level = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line.split("|")
+        if not fields[1].strip().isdigit():
+            continue
+        name = fields[2]
+        modules.add(name.strip())
+        if name.startswith(" ") and not name.startswith("  "):
+            top_level[name.strip()] = int(fields[1])
+    return top_level, modules
+
+def measure(code: str, baseline: set):
+    top_level, modules = run_importtime(code)
+    # Modules loaded by the interpreter itself (site...) are not part of the mode
+    total = sum([cumulative for name, cumulative in top_level.items() if name not in baseline])
+    return total / 1000, modules
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time budget per netatmo.py mode")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mode", type=str, action="append", help="Modes to measure (default all)")
+    parser.add_argument("--budget", type=str, action="append", default=[], help="Override a budget, mode=milliseconds")
+    args = parser.parse_args()
+
+    budgets = {mode: budget for mode, (code, budget, forbidden) in MODES.items()}
+    for value in args.budget:
+        mode, budget = value.split("=")
+        budgets[mode] = float(budget)
+    modes = args.mode if args.mode != None else list(MODES)
+
+    baseline = set(run_importtime("pass")[0])
+    ok = True
+    print(f"{'mode':<10} {'best ms':>8} {'budget':>8}  forbidden modules loaded")
+    for mode in modes:
+        code, budget, forbidden = MODES[mode]
+        timings = []
+        for index in range(args.repeat):
+            elapsed, modules = measure(code, baseline)
+            timings.append(elapsed)
+        loaded = [name for name in forbidden if name in modules]
+        best = min(timings)
+        status = "ok" if best <= budgets[mode] and loaded == [] else "FAILED"
+        print(f"{mode:<10} {best:>8.1f} {budgets[mode]:>8.0f}  {', '.join(loaded) if loaded != [] else '-'} {status}")
+        if status != "ok":
+            ok = False
+    if ok == False:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""
+CPU time of one poll (homesdata/homestatus merge plus mqtt publication) against
+the number of entities, using a synthetic account. No network access is done:
+the mqtt client is replaced by a no-op publisher.
+
+    python3 benchmarks/bench_poll_merge.py --homes 50 --modules 2000
+"""
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from netatmo import MyNetatmo
+
+SETTINGS = """[credentials]
+client_id = bench
+client_secret = bench
+username = bench
+password = bench
+
+[home]
+home_id = bench
+
+[mqtt]
+topic = netatmo2mqtt
+broker = 127.0.0.1
+port = 1883
+
+[global]
+frequency = 5
+
+[logging]
+severity = WARNING
+"""
+
+class NullInfo():
+    rc = 0
+
+class NullClient():
+
+    def publish(self, topic, payload=None, *args, **kwargs):
+        return NullInfo()
+
+def synthetic_account(homes: int, modules: int):
+    homes_data = []
+    all_homestatus = {}
+    modules_per_home = max(modules // homes, 1)
+    for home_index in range(homes):
+        home_id = f"home{home_index:04d}"
+        rooms = []
+        room_status = []
+        home_modules = []
+        module_status = []
+        for module_index in range(modules_per_home):
+            room_id = f"{home_id}room{module_index // 2:04d}"
+            module_id = f"70:ee:50:{home_index:02x}:{module_index // 256:02x}:{module_index % 256:02x}"
+            if module_index % 2 == 0:
+                rooms.append({"id": room_id, "name": f"Room {module_index // 2}", "type": "livingroom", "module_ids": [module_id]})
+                room_status.append({"id": room_id, "reachable": True, "therm_measured_temperature": 20.5, "therm_setpoint_temperature": 21, "therm_setpoint_mode": "schedule", "heating_power_request": 0, "open_window": False, "anticipating": False})
+            home_modules.append({"id": module_id, "type": "NRV", "name": f"Valve {module_index}", "setup_date": 1600000000, "room_id": room_id, "bridge": "70:ee:50:00:00:00"})
+            module_status.append({"id": module_id, "type": "NRV", "battery_state": "full", "battery_level": 3000, "firmware_revision": 100, "rf_strength": 60, "reachable": True, "bridge": "70:ee:50:00:00:00"})
+        homes_data.append({"id": home_id, "name": f"Home {home_index}", "altitude": 100, "coordinates": [2.1, 41.3], "country": "ES", "timezone": "Europe/Madrid", "rooms": rooms, "modules": home_modules, "schedules": []})
+        all_homestatus[home_id] = {"status": "ok", "body": {"home": {"id": home_id, "rooms": room_status, "modules": module_status}}}
+    homesdata_response = {"status": "ok", "body": {"homes": homes_data}}
+    return homesdata_response, all_homestatus
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--homes", type=int, default=50)
+    parser.add_argument("--modules", type=int, default=2000)
+    parser.add_argument("--steps", type=int, default=5, help="number of account sizes up to --homes/--modules")
+    parser.add_argument("--repeat", type=int, default=5)
+    flags = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False) as settings_file:
+        settings_file.write(SETTINGS)
+    try:
+        netatmo_run = MyNetatmo(settings_file=settings_file.name)
+    finally:
+        os.remove(settings_file.name)
+    netatmo_run.get_mqtt().client = NullClient()
+    netatmo_run.get_mqtt().connected = True
+
+    print(f"{'homes':>6} {'modules':>8} {'entities':>9} {'cpu ms/poll':>12}")
+    for step in range(1, flags.steps + 1):
+        homes = max(flags.homes * step // flags.steps, 1)
+        modules = flags.modules * step // flags.steps
+        homesdata_response, all_homestatus = synthetic_account(homes, modules)
+        best = None
+        for _ in range(flags.repeat):
+            homesdata_copy = copy.deepcopy(homesdata_response)
+            homestatus_copy = copy.deepcopy(all_homestatus)
+            started = time.process_time()
+            all_data = netatmo_run.process_netatmo_status(homesdata_copy, homestatus_copy)
+            elapsed = time.process_time() - started
+            if best == None or elapsed < best:
+                best = elapsed
+        entities = len(all_data["homes"]) + len(all_data["rooms"]) + len(all_data["modules"])
+        print(f"{homes:>6} {modules:>8} {entities:>9} {best * 1000:>12.2f}")
+
+if __name__ == "__main__":
+    main()
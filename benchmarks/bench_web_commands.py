@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+Latency of the read endpoints while netatmo commands are in flight. The web app
+runs under uvicorn with a fake netatmo instance whose commands block for
+--delay seconds, like a slow Netatmo api answering through requests.
+
+Each scenario fires --commands concurrent commands and keeps reading /state
+meanwhile. "blocking" calls the command straight from the async handler (the
+old behaviour), "executor" goes through the bounded command pool of the app.
+
+    python3 benchmarks/bench_web_commands.py --commands 8 --delay 2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import aiohttp
+import uvicorn
+from poller import StateSnapshot
+from web import app
+
+class SlowNetatmo():
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.state_snapshot = StateSnapshot()
+        rooms = [{"id": f"room{index}", "therm_measured_temperature": 20.5} for index in range(50)]
+        self.state_snapshot.update({"homes": [{"id": "home"}], "rooms": rooms, "modules": []})
+
+    def setthermmode(self, mode="schedule", optimistic: bool = None):
+        time.sleep(self.delay)
+        return {"status": "ok"}
+
+@app.put("/bench/blocking/setthermode")
+async def put_blocking_setthermode(mode: str):
+    netatmo = app.state.config["instance"]
+    return netatmo.setthermmode(mode=mode)
+
+def start_server(port: int):
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while server.started == False:
+        time.sleep(0.05)
+    return server
+
+async def read_state(session: aiohttp.ClientSession, base_url: str, done: asyncio.Event, latencies: list):
+    while not done.is_set():
+        started = time.perf_counter()
+        async with session.get(f"{base_url}/state") as response:
+            await response.read()
+        latencies.append(time.perf_counter() - started)
+
+async def send_command(session: aiohttp.ClientSession, url: str, statuses: list):
+    async with session.put(url, params={"mode": "schedule"}) as response:
+        await response.read()
+        statuses.append(response.status)
+
+async def scenario(base_url: str, path: str, commands: int):
+    latencies = []
+    statuses = []
+    done = asyncio.Event()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        reader = asyncio.create_task(read_state(session, base_url, done, latencies))
+        started = time.perf_counter()
+        await asyncio.gather(*[send_command(session, f"{base_url}{path}", statuses) for _ in range(commands)])
+        elapsed = time.perf_counter() - started
+        done.set()
+        await reader
+    return latencies, statuses, elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=2, help="seconds each fake netatmo command blocks")
+    parser.add_argument("--workers", type=int, default=4, help="command_workers of the web app")
+    parser.add_argument("--port", type=int, default=8765)
+    flags = parser.parse_args()
+
+    app.state.config = {
+        "config": {},
+        "instance": SlowNetatmo(flags.delay),
+        "command_workers": flags.workers,
+        "command_timeout": flags.delay * 4
+    }
+    server = start_server(flags.port)
+    base_url = f"http://127.0.0.1:{flags.port}"
+    scenarios = [("blocking", "/bench/blocking/setthermode"), ("executor", "/setthermode")]
+
+    print(f"{'scenario':>9} {'reads':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'commands':>9} {'elapsed s':>10}")
+    for name, path in scenarios:
+        latencies, statuses, elapsed = asyncio.run(scenario(base_url, path, flags.commands))
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        codes = ",".join(f"{code}x{statuses.count(code)}" for code in sorted(set(statuses)))
+        print(f"{name:>9} {len(latencies):>6} {p50:>8.2f} {p99:>8.2f} {latencies[-1] * 1000:>8.2f} {codes:>9} {elapsed:>10.2f}")
+    server.should_exit = True
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+"""
+Checks that concurrent callers needing a token trigger a single web login per
+account. A local fake of the Netatmo auth server counts the logins and makes
+each one slow (--login-delay) so that callers really overlap.
+
+Scenarios:
+  one_instance     --threads callers of get_session_headers on one Netatmo_API
+  many_instances   --threads callers of get_token spread over --instances Netatmo_API of the same account
+  token_rejected   --threads api calls after the server revoked the current token
+  many_processes   --processes processes of the same account sharing the token store
+
+Each scenario must end with exactly one login, the script exits 1 otherwise.
+
+    python3 benchmarks/harness_single_flight.py --threads 20 --instances 4
+"""
+import argparse
+import email.utils
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from netatmo_api import Netatmo_API
+
+class FakeNetatmo():
+
+    def __init__(self, login_delay: float):
+        self.login_delay = login_delay
+        self.lock = threading.Lock()
+        self.logins = 0
+        self.issued = 0
+        self.current_token = None
+
+    def reset(self):
+        with self.lock:
+            self.logins = 0
+
+    def revoke(self):
+        with self.lock:
+            self.current_token = None
+
+    def login(self):
+        time.sleep(self.login_delay)
+        with self.lock:
+            self.logins += 1
+            self.issued += 1
+            self.current_token = f"user|token{self.issued}"
+            return self.current_token
+
+    def is_valid(self, authorization: str):
+        with self.lock:
+            return self.current_token != None and authorization == f"Bearer {self.current_token}"
+
+def get_handler(fake: FakeNetatmo):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status: int, payload: dict = None, cookie: str = None):
+            body = json.dumps(payload if payload != None else {}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if cookie != None:
+                self.send_header("Set-Cookie", cookie)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path.endswith("/access/login"):
+                self.reply(200, cookie="netatmocomci_csrf_cookie_na=csrf; Path=/")
+            elif path == "/access/csrf":
+                self.reply(200, {"token": "csrf"})
+            elif path == "/access/keychain":
+                self.reply(302)
+            elif path.startswith("/api/"):
+                if fake.is_valid(self.headers.get("Authorization")):
+                    self.reply(200, {"status": "ok", "body": {"homes": []}})
+                else:
+                    self.reply(403, {"error": {"code": 3, "message": "Access token expired"}})
+            else:
+                self.reply(404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+            if self.path == "/access/postlogin":
+                token = fake.login().replace("|", "%7C")
+                expires = email.utils.formatdate(time.time() + 10800, usegmt=True)
+                self.reply(302, cookie=f"netatmocomaccess_token={token}; Expires={expires}; Path=/")
+            else:
+                self.reply(404)
+
+    return Handler
+
+def get_api(base_url: str, token_file: str):
+    return Netatmo_API("client_id", "client_secret", "user@example.com", "password", endpoint=base_url,
+                       auth_endpoint=base_url, app_endpoint=base_url, token_file=token_file)
+
+def get_process_token(base_url: str, token_file: str):
+    return get_api(base_url, token_file).get_token()
+
+def run_threads(count: int, target):
+    errors = []
+    def call(index):
+        try:
+            target(index)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, errors
+
+def check(name: str, fake: FakeNetatmo, elapsed: float, errors: list):
+    print(f"{name:<16} logins={fake.logins} errors={len(errors)} {elapsed:.2f}s")
+    for error in errors[:3]:
+        print(f"    {error!r}")
+    return fake.logins == 1 and errors == []
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent logins against a fake netatmo auth server")
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--instances", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--login-delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    fake = FakeNetatmo(args.login_delay)
+    server = ThreadingHTTPServer(("localhost", 0), get_handler(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://localhost:{server.server_address[1]}"
+    ok = True
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        token_file = os.path.join(temp_dir, "token.json")
+
+        netatmo = get_api(base_url, token_file)
+        elapsed, errors = run_threads(args.threads, lambda index: netatmo.get_session_headers())
+        ok = check("one_instance", fake, elapsed, errors) and ok
+
+        if os.path.exists(token_file):
+            os.remove(token_file)
+        fake.reset()
+        instances = [get_api(base_url, token_file) for index in range(args.instances)]
+        elapsed, errors = run_threads(args.threads, lambda index: instances[index % len(instances)].get_token())
+        ok = check("many_instances", fake, elapsed, errors) and ok
+
+        # Every instance holds a token the server no longer accepts
+        fake.revoke()
+        fake.reset()
+        netatmo = instances[0]
+        def request(index):
+            payload = netatmo.api_request("GET", "homesdata")
+            if payload.get("status") != "ok":
+                raise Exception(f"Request failed {payload}")
+        elapsed, errors = run_threads(args.threads, request)
+        ok = check("token_rejected", fake, elapsed, errors) and ok
+
+        os.remove(token_file)
+        fake.reset()
+        started = time.perf_counter()
+        with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+            tokens = pool.starmap(get_process_token, [(base_url, token_file)] * args.processes)
+        errors = [] if len(set(tokens)) == 1 else [Exception(f"Different tokens {set(tokens)}")]
+        ok = check("many_processes", fake, time.perf_counter() - started, errors) and ok
+
+    server.shutdown()
+    if ok == False:
+        print("FAILED: expected exactly one login per scenario")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
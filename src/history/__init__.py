@@ -0,0 +1 @@
+from .store import HistoryStore
\ No newline at end of file
@@ -0,0 +1,169 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+class HistoryStore():
+    """
+    SQLite store of the numeric readings of every poll. Raw rows are kept for
+    raw_retention days, and each reading also updates 1 minute, 1 hour and 1 day
+    rollups (count, sum, min, max) with their own retention, so range queries
+    read one row per bucket and never scan raw rows. Retention 0 keeps forever.
+    """
+
+    db_file = "tmp/history.sqlite"
+    # Fields recorded for rooms and modules, non numeric values are ignored
+    room_fields = ["therm_measured_temperature", "therm_setpoint_temperature", "heating_power_request"]
+    module_fields = ["battery_level", "rf_strength", "wifi_strength", "boiler_status"]
+    # resolution -> (bucket seconds, table)
+    resolutions = {
+        "1m": (60, "rollup_1m"),
+        "1h": (3600, "rollup_1h"),
+        "1d": (86400, "rollup_1d")
+    }
+    # Retention in days per table
+    retention = {
+        "raw": 7,
+        "1m": 30,
+        "1h": 365,
+        "1d": 0
+    }
+    # Seconds between two retention passes
+    prune_interval = 3600
+    # With resolution auto, the finest rollup returning at most max_points buckets
+    max_points = 500
+
+    def __init__(self, db_file: str = None, retention: dict = None):
+        if db_file != None:
+            self.db_file = db_file
+        self.retention = dict(self.retention)
+        if retention != None:
+            self.retention.update(retention)
+        db_dir = os.path.dirname(os.path.realpath(self.db_file))
+        if not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.last_prune = 0
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS raw (entity_id TEXT, field TEXT, ts INTEGER, value REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS raw_entity ON raw (entity_id, ts)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS raw_ts ON raw (ts)")
+            for bucket_seconds, table in self.resolutions.values():
+                self.connection.execute(f"CREATE TABLE IF NOT EXISTS {table} (entity_id TEXT, field TEXT, bucket INTEGER, count INTEGER, sum REAL, min REAL, max REAL, "
+                                        "PRIMARY KEY (entity_id, bucket, field)) WITHOUT ROWID")
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_bucket ON {table} (bucket)")
+            self.connection.commit()
+
+    def get_readings(self, all_data: dict):
+        readings = []
+        for entities, fields in [(all_data["rooms"], self.room_fields), (all_data["modules"], self.module_fields)]:
+            for entity in entities:
+                for field in fields:
+                    value = entity.get(field)
+                    if type(value) in [int, float, bool]:
+                        readings.append((entity["id"], field, float(value)))
+        return readings
+
+    def record(self, all_data: dict, timestamp: float = None):
+        if timestamp == None:
+            timestamp = time.time()
+        ts = int(timestamp)
+        readings = self.get_readings(all_data)
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT INTO raw (entity_id, field, ts, value) VALUES (?, ?, ?, ?)",
+                                            [(entity_id, field, ts, value) for entity_id, field, value in readings])
+                for bucket_seconds, table in self.resolutions.values():
+                    bucket = ts - ts % bucket_seconds
+                    self.connection.executemany(f"INSERT INTO {table} (entity_id, field, bucket, count, sum, min, max) VALUES (?, ?, ?, 1, ?, ?, ?) "
+                                                "ON CONFLICT (entity_id, bucket, field) DO UPDATE SET count = count + 1, sum = sum + excluded.sum, "
+                                                "min = min(min, excluded.min), max = max(max, excluded.max)",
+                                                [(entity_id, field, bucket, value, value, value) for entity_id, field, value in readings])
+        if timestamp - self.last_prune >= self.prune_interval:
+            self.prune(timestamp)
+        return len(readings)
+
+    def prune(self, timestamp: float = None):
+        if timestamp == None:
+            timestamp = time.time()
+        tables = [("raw", "raw", "ts")] + [(resolution, table, "bucket") for resolution, (bucket_seconds, table) in self.resolutions.items()]
+        deleted = 0
+        with self.lock:
+            with self.connection:
+                for resolution, table, column in tables:
+                    days = self.retention.get(resolution, 0)
+                    if days <= 0:
+                        continue
+                    cursor = self.connection.execute(f"DELETE FROM {table} WHERE {column} < ?", (int(timestamp - days * 86400),))
+                    deleted += cursor.rowcount
+        self.last_prune = timestamp
+        if deleted > 0:
+            logger.info(f"Removed {deleted} history rows beyond retention")
+        return deleted
+
+    def get_resolution(self, start: float, end: float):
+        for resolution, (bucket_seconds, table) in self.resolutions.items():
+            if (end - start) / bucket_seconds <= self.max_points:
+                return resolution
+        return "1d"
+
+    def query(self, entity_id: str, start: float = None, end: float = None, resolution: str = "auto", field: str = None):
+        """
+        Returns {field: [[timestamp, avg, min, max], ...]} between start and end (unix seconds).
+        resolution is auto, 1m, 1h, 1d or raw.
+        """
+        if end == None:
+            end = time.time()
+        if start == None:
+            start = end - 86400
+        if resolution == "auto":
+            resolution = self.get_resolution(start, end)
+        if resolution == "raw":
+            sql = "SELECT field, ts, value, value, value FROM raw WHERE entity_id = ? AND ts >= ? AND ts <= ?"
+        elif resolution in self.resolutions:
+            bucket_seconds, table = self.resolutions[resolution]
+            start = start - start % bucket_seconds
+            sql = f"SELECT field, bucket, sum / count, min, max FROM {table} WHERE entity_id = ? AND bucket >= ? AND bucket <= ?"
+        else:
+            raise ValueError(f"Invalid resolution {resolution}. Use auto, raw, " + ", ".join(self.resolutions.keys()))
+        parameters = [entity_id, int(start), int(end)]
+        if field != None:
+            sql += " AND field = ?"
+            parameters.append(field)
+        sql += " ORDER BY 2"
+        series = {}
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        for row_field, ts, average, minimum, maximum in rows:
+            series.setdefault(row_field, []).append([ts, average, minimum, maximum])
+        payload = {
+            "entity_id": entity_id,
+            "resolution": resolution,
+            "start": start,
+            "end": end,
+            "fields": series
+        }
+        return payload
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
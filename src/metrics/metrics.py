@@ -0,0 +1,124 @@
+import functools
+import logging
+import os
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+lazy_metrics = []
+
+class LazyMetric():
+    """
+    Prometheus metric created on its first use, so that importing the metrics does
+    not load prometheus_client (one-shot commands never expose them). Attributes
+    (labels, inc, observe, set...) are those of the prometheus_client metric.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, kind: str, *args, **kwargs):
+        # kind is the prometheus_client class: Counter, Gauge or Histogram
+        self.kind = kind
+        self.args = args
+        self.kwargs = kwargs
+        self.metric = None
+        lazy_metrics.append(self)
+
+    def get_metric(self):
+        if self.metric == None:
+            with self.lock:
+                if self.metric == None:
+                    import prometheus_client
+                    self.metric = getattr(prometheus_client, self.kind)(*self.args, **self.kwargs)
+        return self.metric
+
+    def __getattr__(self, name):
+        return getattr(self.get_metric(), name)
+
+def Counter(*args, **kwargs):
+    return LazyMetric("Counter", *args, **kwargs)
+
+def Gauge(*args, **kwargs):
+    return LazyMetric("Gauge", *args, **kwargs)
+
+def Histogram(*args, **kwargs):
+    return LazyMetric("Histogram", *args, **kwargs)
+
+# Netatmo api
+API_REQUEST_SECONDS = Histogram("netatmo_api_request_duration_seconds", "Latency of the Netatmo api calls", ["method", "endpoint"],
+                                buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 15, 30))
+API_RESPONSES = Counter("netatmo_api_responses_total", "Netatmo api responses by http status", ["endpoint", "status"])
+API_RESPONSE_BYTES = Counter("netatmo_api_response_bytes_total", "Bytes received from the Netatmo api", ["endpoint"])
+API_QUOTA_WAIT_SECONDS = Histogram("netatmo_api_quota_wait_seconds", "Time waited for the Netatmo api quota", ["endpoint"],
+                                   buckets=(0.01, 0.1, 1, 5, 10, 30, 60, 300))
+API_RATE_LIMITED = Counter("netatmo_api_rate_limited_total", "Netatmo api calls rejected by the rate limits")
+
+# Polls, account is the [account:<name>] of the poll or "default"
+POLL_SECONDS = Histogram("netatmo_poll_duration_seconds", "Duration of a full netatmo status poll", ["account"],
+                         buckets=(0.25, 0.5, 1, 2, 5, 10, 20, 30, 60))
+POLL_FAILURES = Counter("netatmo_poll_failures_total", "Polls that raised or got an api error", ["account"])
+POLL_ENTITIES = Gauge("netatmo_poll_entities", "Entities processed by the last poll", ["account", "kind"])
+POLL_LAST_SUCCESS = Gauge("netatmo_poll_last_success_timestamp_seconds", "Unix time of the last successful poll", ["account"])
+POLL_INTERVAL = Gauge("netatmo_poll_interval_seconds", "Current adaptive poll interval", ["account"])
+
+# Mqtt
+MQTT_PUBLISHED = Counter("mqtt_messages_published_total", "Messages handed to the mqtt broker")
+MQTT_SKIPPED = Counter("mqtt_messages_skipped_total", "Entities not published because nothing changed")
+MQTT_SPOOLED = Counter("mqtt_messages_spooled_total", "Publishes that failed because the broker was unreachable and went to the spool")
+MQTT_SPOOL_SIZE = Gauge("mqtt_spool_messages", "Messages waiting in the offline spool")
+MQTT_RECONNECTS = Counter("mqtt_reconnects_total", "Unexpected disconnections from the mqtt broker")
+MQTT_CONNECTED = Gauge("mqtt_connected", "1 while connected to the mqtt broker")
+
+# Commands
+COMMAND_SECONDS = Histogram("netatmo_command_duration_seconds", "Duration of the commands sent to netatmo", ["command"],
+                            buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+COMMANDS = Counter("netatmo_commands_total", "Commands sent to netatmo by result", ["command", "result"])
+COMMAND_QUEUE_DEPTH = Gauge("netatmo_command_queue_depth", "Mqtt commands waiting for a worker")
+COMMANDS_DROPPED = Counter("netatmo_commands_dropped_total", "Mqtt commands dropped because the queue was full")
+
+def observe_api_request(method: str, api_name: str, status_code: int, duration: float, content: bytes = None):
+    API_REQUEST_SECONDS.labels(method, api_name).observe(duration)
+    API_RESPONSES.labels(api_name, str(status_code)).inc()
+    if content != None:
+        API_RESPONSE_BYTES.labels(api_name).inc(len(content))
+
+def timed_command(command: str):
+    """
+    Decorator for the command entry points. A response is ok when netatmo answered
+    status ok, errors are counted and raised again.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            result = "error"
+            try:
+                response = function(*args, **kwargs)
+                if type(response) == dict and response.get("status") == "ok":
+                    result = "ok"
+                else:
+                    result = "failed"
+                return response
+            finally:
+                COMMAND_SECONDS.labels(command).observe(time.monotonic() - started)
+                COMMANDS.labels(command, result).inc()
+        return wrapper
+    return decorator
+
+def get_metrics():
+    # Prometheus text exposition of every metric of the process, including the ones never used yet
+    from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+    for metric in lazy_metrics:
+        metric.get_metric()
+    return generate_latest(), CONTENT_TYPE_LATEST
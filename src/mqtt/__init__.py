@@ -1 +1,4 @@
-from .mqtt import *
\ No newline at end of file
+from .mqtt import *
+from .delta import DeltaTracker
+from .dispatcher import CommandDispatcher
+from .eventlog import EventLog
\ No newline at end of file
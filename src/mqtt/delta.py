@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class DeltaTracker():
+    """
+    Remembers the last published state per entity id so that unchanged
+    entities (or fields) are not published again on every poll.
+    """
+
+    # Seconds between forced full publications, 0 disables the resync
+    resync_interval = 0
+
+    def __init__(self, resync_interval: int = None):
+        if resync_interval != None:
+            self.resync_interval = int(resync_interval)
+        self.last_state = {}
+        # scope (topic of an account) -> time of its last full publication
+        self.last_resync = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def changed_fields(self, item: str, payload: dict):
+        with self.lock:
+            previous = self.last_state.get(item)
+        if previous == None:
+            return dict(payload)
+        changed = {}
+        for field, value in payload.items():
+            if field not in previous or previous[field] != value:
+                changed[field] = value
+        return changed
+
+    def update(self, item: str, payload: dict, fields: dict = None):
+        with self.lock:
+            if fields == None or item not in self.last_state:
+                self.last_state[item] = dict(payload)
+            else:
+                self.last_state[item].update(fields)
+
+    def resync_due(self, scope: str = None):
+        if self.resync_interval <= 0:
+            return False
+        return time.time() - self.last_resync.get(scope, self.started) >= self.resync_interval
+
+    def mark_resync(self, scope: str = None):
+        self.last_resync[scope] = time.time()
+
+    def reset(self, item: str = None):
+        with self.lock:
+            if item == None:
+                self.last_state = {}
+            elif item in self.last_state:
+                del self.last_state[item]
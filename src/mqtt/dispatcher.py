@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from metrics import COMMAND_QUEUE_DEPTH, COMMANDS_DROPPED
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+
+class CommandDispatcher():
+    """
+    Runs mqtt commands on worker threads instead of the paho network thread.
+    Commands are keyed by (handler, item, topic): while a key waits in the queue, newer
+    values replace the older one, so a burst becomes a single call with the
+    latest value. A key is never executed by two workers at the same time.
+    """
+
+    workers = 2
+    max_pending = 100
+    # Seconds a new command waits for newer values of the same key before running
+    coalesce_delay = 1.0
+
+    def __init__(self, handler, workers: int = None, max_pending: int = None, coalesce_delay: float = None):
+        self.handler = handler
+        if workers != None:
+            self.workers = int(workers)
+        if max_pending != None:
+            self.max_pending = int(max_pending)
+        if coalesce_delay != None:
+            self.coalesce_delay = float(coalesce_delay)
+        self.condition = threading.Condition()
+        # (handler, item, topic) -> [value, ready_at]
+        self.pending = OrderedDict()
+        self.in_flight = set()
+        self.threads = []
+        self.running = False
+        self.submitted = 0
+        self.merged = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        with self.condition:
+            if self.running == True:
+                return
+            self.running = True
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.worker_loop, name=f"netatmo_command_{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Started {self.workers} command workers")
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def submit(self, item: str, topic: str, value, handler=None):
+        # handler defaults to the dispatcher one, accounts sharing the dispatcher pass their own
+        if handler == None:
+            handler = self.handler
+        key = (handler, item, topic)
+        with self.condition:
+            self.submitted += 1
+            if key in self.pending:
+                self.pending[key][0] = value
+                self.merged += 1
+                return True
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                COMMANDS_DROPPED.inc()
+                logger.warning(f"Command queue full, dropping item={item} topic={topic} value={value}")
+                return False
+            self.pending[key] = [value, time.monotonic() + self.coalesce_delay]
+            COMMAND_QUEUE_DEPTH.set(len(self.pending))
+            self.condition.notify()
+        return True
+
+    def next_command(self):
+        # First pending key that is ready and not already running, or the seconds to wait
+        now = time.monotonic()
+        wait = None
+        for key, (value, ready_at) in self.pending.items():
+            if key in self.in_flight:
+                continue
+            if ready_at <= now:
+                return key, None
+            if wait == None or ready_at - now < wait:
+                wait = ready_at - now
+        return None, wait
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.running == False:
+                        return
+                    key, wait = self.next_command()
+                    if key != None:
+                        break
+                    self.condition.wait(timeout=wait)
+                value = self.pending.pop(key)[0]
+                COMMAND_QUEUE_DEPTH.set(len(self.pending))
+                self.in_flight.add(key)
+            handler, item, topic = key
+            try:
+                handler(item, topic, value)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Exception running command item={item} topic={topic} value={value} " + str(e))
+            finally:
+                with self.condition:
+                    self.in_flight.discard(key)
+                    self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            stats = {
+                "queue_depth": len(self.pending),
+                "in_flight": len(self.in_flight),
+                "submitted": self.submitted,
+                "merged": self.merged,
+                "dropped": self.dropped,
+                "processed": self.processed,
+                "failed": self.failed
+            }
+        return stats
@@ -0,0 +1,92 @@
+import itertools
+import threading
+from collections import deque
+
+
+class EventLog():
+    """
+    Fixed capacity ring buffer of mqtt events (sequence, timestamp, item, topic, payload).
+    Payloads are kept by reference. Events are indexed by item and, through their
+    append order, by time and sequence. Several logs can share one sequence so a
+    cursor is valid across all of them.
+    """
+
+    capacity = 1000
+
+    def __init__(self, capacity: int = None, sequence=None):
+        if capacity != None:
+            self.capacity = max(int(capacity), 1)
+        if sequence == None:
+            sequence = itertools.count(1)
+        self.sequence = sequence
+        self.lock = threading.Lock()
+        self.slots = [None] * self.capacity
+        # Positions are append counters, the slot of a position is position % capacity
+        self.next_position = 0
+        # item -> positions of its events, oldest first
+        self.by_item = {}
+        self.last_timestamp = 0
+
+    def __len__(self):
+        with self.lock:
+            return min(self.next_position, self.capacity)
+
+    def append(self, item: str, topic: str, payload, timestamp: float):
+        with self.lock:
+            position = self.next_position
+            slot = position % self.capacity
+            evicted = self.slots[slot]
+            if evicted != None:
+                evicted_positions = self.by_item[evicted[2]]
+                evicted_positions.popleft()
+                if len(evicted_positions) == 0:
+                    del self.by_item[evicted[2]]
+            # Times must not go backwards for the time index
+            timestamp = max(timestamp, self.last_timestamp)
+            self.last_timestamp = timestamp
+            sequence = next(self.sequence)
+            self.slots[slot] = (sequence, timestamp, item, topic, payload)
+            self.by_item.setdefault(item, deque()).append(position)
+            self.next_position += 1
+        return sequence
+
+    def get_event(self, position: int):
+        return self.slots[position % self.capacity]
+
+    def first_position(self, field: int, value: float):
+        # First live position whose sequence (field 0) or timestamp (field 1) is >= value
+        low = max(self.next_position - self.capacity, 0)
+        high = self.next_position
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_event(middle)[field] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, item: str = None, since: float = None, limit: int = 100, cursor: int = None):
+        """
+        Newest first. since keeps events at or after that unix time, cursor keeps events
+        with a lower sequence (pass the last sequence of the previous page).
+        """
+        events = []
+        with self.lock:
+            start = max(self.next_position - self.capacity, 0)
+            end = self.next_position
+            if since != None:
+                start = self.first_position(1, since)
+            if cursor != None:
+                end = self.first_position(0, cursor)
+            if item == None:
+                positions = range(end - 1, start - 1, -1)
+            else:
+                positions = reversed(self.by_item.get(item, []))
+            for position in positions:
+                if position >= end:
+                    continue
+                if position < start or len(events) >= limit:
+                    break
+                sequence, timestamp, event_item, topic, payload = self.get_event(position)
+                events.append({"sequence": sequence, "topic": topic, "item": event_item, "payload": payload, "timestamp": timestamp})
+        return events
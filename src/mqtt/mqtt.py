@@ -1,8 +1,11 @@
 import logging
 import json
-import paho.mqtt.client as paho
 import os
 import time
+import threading
+from .delta import DeltaTracker
+from .spool import OfflineSpool
+from metrics import MQTT_PUBLISHED, MQTT_SKIPPED, MQTT_SPOOLED, MQTT_SPOOL_SIZE, MQTT_RECONNECTS, MQTT_CONNECTED
 
 
 logging.basicConfig(level=logging.INFO)
@@ -16,14 +19,35 @@ logging_formatter = logging.Formatter(
 stream_handler.setFormatter(logging_formatter)
 logger.addHandler(stream_handler)
 
+# paho.mqtt.client.MQTT_ERR_NO_CONN, paho itself is imported with the first client
+MQTT_ERR_NO_CONN = 4
+
 class MQTT():
 
     broker = "127.0.0.1"
     port = 1883
     topic = "netatmo"
     client = None
+    delta = False
+    full_cycle = True
+    messages_sent = 0
+    messages_skipped = 0
+    publisher = False
+    loop_started = False
+    qos = 0
+    retain = False
+    max_inflight = 20
+    publish_timeout = 30
+    reconnect_min_delay = 1
+    reconnect_max_delay = 120
+    reconnects = 0
+    connected = False
+    # Seconds waiting for the broker to accept the connection when publishing without a network loop
+    connect_timeout = 10
+    publish_mode = "json"
 
-    def __init__(self, broker=None, port=None, topic=None):
+    def __init__(self, broker=None, port=None, topic=None, delta=None, resync_interval=None, publisher=None, qos=None, retain=None, max_inflight=None,
+                 spool_size=None, spool_file=None, reconnect_min_delay=None, reconnect_max_delay=None, publish_mode=None):
         logger.info("Init")
         if broker != None:
             self.broker = broker
@@ -31,11 +55,169 @@ class MQTT():
             self.port = int(port)
         if topic != None:
             self.topic = topic
+        if delta != None:
+            self.delta = delta
+        if publisher != None:
+            self.publisher = publisher
+        if qos != None:
+            self.qos = int(qos)
+        if retain != None:
+            self.retain = retain
+        if max_inflight != None:
+            self.max_inflight = int(max_inflight)
+        if publish_mode != None:
+            if publish_mode not in ["json", "fields", "both"]:
+                raise Exception(f"Invalid mqtt publish_mode {publish_mode}. Use json, fields or both")
+            self.publish_mode = publish_mode
+        if reconnect_min_delay != None:
+            self.reconnect_min_delay = int(reconnect_min_delay)
+        if reconnect_max_delay != None:
+            self.reconnect_max_delay = int(reconnect_max_delay)
+        self.tracker = DeltaTracker(resync_interval=resync_interval)
+        self.spool = OfflineSpool(memory_size=spool_size, spool_file=spool_file)
+        self.spool.load()
+        MQTT_SPOOL_SIZE.set(len(self.spool))
+        # topic -> (qos, on_message) restored after every reconnection
+        self.subscriptions = {}
+        # (topic, item) -> {field: full topic}
+        self.field_topics = {}
+        self.stopped = threading.Event()
+        self.replay_lock = threading.Lock()
         pass
 
-    def send_message(self, payload, topic=None, item=None, mode="state"):
+    def start_publisher(self):
+        # Dedicated background network loop: publishes never wait for the subscriber loop
         if self.client == None:
             self.__connect_queue()
+        if self.loop_started == False:
+            logger.info(f"Starting mqtt publisher loop qos={self.qos} retain={self.retain} max_inflight={self.max_inflight}")
+            self.client.loop_start()
+            self.loop_started = True
+
+    def stop(self):
+        if self.loop_started == True:
+            self.client.loop_stop()
+            self.loop_started = False
+        self.stopped.set()
+
+    def start_cycle(self, topic=None):
+        # Called once per poll. Decides whether this cycle republishes every entity of topic
+        if self.delta == False and self.publish_mode == "json":
+            self.full_cycle = True
+        elif self.tracker.resync_due(topic):
+            logger.info("Full mqtt resync")
+            self.tracker.mark_resync(topic)
+            self.full_cycle = True
+        else:
+            self.full_cycle = False
+        return self.full_cycle
+
+    def get_state_key(self, item, topic=None):
+        # Entities of different accounts publish under different topics and may share ids
+        if topic == None:
+            topic = self.topic
+        return f"{topic}/{item}"
+
+    def get_changed_fields(self, key, payload, full_cycle=None):
+        # Every field during a full cycle, otherwise only the fields that changed since last publication
+        if full_cycle == None:
+            full_cycle = self.full_cycle
+        if full_cycle == True:
+            return dict(payload)
+        return self.tracker.changed_fields(key, payload)
+
+    def get_field_topics(self, item, fields, topic=None):
+        # Topic strings per entity and field are built once and reused every poll
+        if topic == None:
+            topic = self.topic
+        topics = self.field_topics.setdefault((topic, item), {})
+        for field in fields:
+            if field not in topics:
+                topics[field] = f"{topic}/{item}/{field}"
+        return topics
+
+    def format_field(self, value):
+        if type(value) == str:
+            return value
+        return json.dumps(value)
+
+    def send_state(self, payload, item, topic=None):
+        # Publishes the entity only when delta mode is off or some field changed
+        return self.send_states([(item, payload)], topic=topic)[0]
+
+    def send_states(self, states: list, topic=None, full_cycle=None):
+        """
+        Publishes a whole poll as one pipelined burst. states is a list of (item, payload),
+        full_cycle the decision of start_cycle when several accounts share the connection.
+        Returns the list of flags telling which states were published.
+        """
+        messages = []
+        field_messages = []
+        published = []
+        for item, payload in states:
+            key = self.get_state_key(item, topic)
+            changed = self.get_changed_fields(key, payload, full_cycle)
+            if changed == {}:
+                self.messages_skipped += 1
+                MQTT_SKIPPED.inc()
+                published.append(False)
+                continue
+            if self.publish_mode in ["json", "both"]:
+                messages.append({"payload": payload, "item": item, "topic": topic})
+            if self.publish_mode in ["fields", "both"]:
+                field_topics = self.get_field_topics(item, changed, topic)
+                for field, value in changed.items():
+                    field_messages.append((field_topics[field], self.format_field(value), self.qos, True))
+            self.tracker.update(key, payload)
+            published.append(True)
+        self.publish_batch(messages, field_messages=field_messages)
+        return published
+
+    def publish_batch(self, messages: list, wait: bool = True, field_messages: list = None):
+        """
+        Queue every message first, then wait for the broker acknowledgements (qos > 0) all together.
+        messages are send_message keyword arguments, field_messages (topic, message, qos, retain) tuples.
+        """
+        infos = [self.send_message(**message) for message in messages]
+        if field_messages != None:
+            infos += [self.publish(*field_message) for field_message in field_messages]
+        infos = [info for info in infos if info != None]
+        if wait == True and self.qos > 0 and self.loop_started == True:
+            deadline = time.time() + self.publish_timeout
+            for info in infos:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warning("Timeout waiting for mqtt publish acknowledgements")
+                    break
+                info.wait_for_publish(timeout=remaining)
+        return infos
+
+    def get_stats(self):
+        stats = {
+            "delta": self.delta,
+            "publish_mode": self.publish_mode,
+            "messages_sent": self.messages_sent,
+            "messages_skipped": self.messages_skipped,
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "spooled": len(self.spool),
+            "spool_dropped": self.spool.dropped
+        }
+        return stats
+
+    def get_client(self):
+        if self.client == None:
+            if self.publisher == True:
+                self.start_publisher()
+            else:
+                self.__connect_queue()
+        return self.client
+
+    def send_message(self, payload, topic=None, item=None, mode="state", qos=None, retain=None):
+        if qos == None:
+            qos = self.qos
+        if retain == None:
+            retain = self.retain
         if topic == None:
             topic = self.topic
         if type(payload) == str:
@@ -46,8 +228,42 @@ class MQTT():
             topic = f"{topic}/{item}/{mode}"
         else:
             topic = f"{topic}/{mode}"
-        self.client.publish(topic, message)
-        pass
+        return self.publish(topic, message, qos=qos, retain=retain)
+
+    def publish(self, topic, message, qos=0, retain=False):
+        self.get_client()
+        # While offline, or while the spool is being replayed, keep ordering by spooling.
+        # Decided under the replay lock: a message spooled after the replay found the spool empty would stay there
+        with self.replay_lock:
+            if self.connected == False or len(self.spool) > 0:
+                self.put_spool(topic, message, qos, retain)
+                return None
+            info = self.client.publish(topic, message, qos=qos, retain=retain)
+            if info.rc == MQTT_ERR_NO_CONN:
+                self.put_spool(topic, message, qos, retain)
+                return None
+        self.messages_sent += 1
+        MQTT_PUBLISHED.inc()
+        return info
+
+    def put_spool(self, topic, message, qos=0, retain=False):
+        self.spool.put(topic, message, qos, retain)
+        MQTT_SPOOLED.inc()
+        MQTT_SPOOL_SIZE.set(len(self.spool))
+
+    def replay_spool(self):
+        with self.replay_lock:
+            while len(self.spool) > 0 and self.connected == True:
+                messages = self.spool.drain()
+                logger.info(f"Replaying {len(messages)} mqtt messages published while offline")
+                for topic, message, qos, retain in messages:
+                    info = self.client.publish(topic, message, qos=qos, retain=retain)
+                    if info.rc == MQTT_ERR_NO_CONN:
+                        self.spool.put(topic, message, qos, retain)
+                    else:
+                        self.messages_sent += 1
+                        MQTT_PUBLISHED.inc()
+            MQTT_SPOOL_SIZE.set(len(self.spool))
 
     def mqtt_on_message(self, client, userdata, message):
         if not message.topic.endswith("/state"):
@@ -57,31 +273,68 @@ class MQTT():
             logger.info(f"message qos={message.qos}")
             logger.info(f"message retain flag={message.retain}")
 
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"Connection to mqtt broker {self.broker}:{self.port} refused rc={rc}")
+            return
+        logger.info(f"Connected to mqtt broker {self.broker}:{self.port}")
+        self.connected = True
+        MQTT_CONNECTED.set(1)
+        for topic, (qos, on_message) in self.subscriptions.items():
+            logger.info(f"Subscribing to mqtt topic {topic}")
+            client.subscribe(topic, qos=qos)
+        # Replay from a separate thread, waiting for qos acknowledgements needs the network loop
+        threading.Thread(target=self.replay_spool, name="mqtt_replay", daemon=True).start()
+
     def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        MQTT_CONNECTED.set(0)
         if rc != 0:
+            # paho reconnects by itself with exponential backoff between reconnect_min_delay and reconnect_max_delay
+            self.reconnects += 1
+            MQTT_RECONNECTS.inc()
             logger.warning("Unexpected MQTT disconnection. Attempting to reconnect.")
-            try:
-                self.client.reconnect()
-            except Exception as e:
-                logger.error(f"Error trying to reconnect to mqtt. Exception " + str(e))
 
     def subscribe_topic(self, topic=None, qos=1, on_message=None):
         if self.client == None:
             self.__connect_queue()
         if topic == None:
             topic = f"{self.topic}/+/update" 
-        logger.info(f"Subscribing to mqtt topic {topic}")
-        self.client.subscribe(topic, qos=qos)
         if on_message == None:
             self.client.on_message=self.mqtt_on_message
         else:
             self.client.on_message=on_message
-        self.on_disconnect=self.on_disconnect
-        self.client.loop_forever()
+        self.subscriptions[topic] = (qos, on_message)
+        if self.connected == True:
+            logger.info(f"Subscribing to mqtt topic {topic}")
+            self.client.subscribe(topic, qos=qos)
+        if self.loop_started == True:
+            # The publisher loop already services this client
+            self.stopped.wait()
+        else:
+            self.client.loop_forever(retry_first_connection=True)
 
     def __connect_queue(self):
+        # Imported with the first client, one-shot commands that never publish do not load paho
+        import paho.mqtt.client as paho
         paho_client = "mqtt_netatmo_" + str(time.time())
         client = paho.Client(paho_client)
-        client.connect(self.broker, self.port)
+        client.max_inflight_messages_set(self.max_inflight)
+        client.reconnect_delay_set(min_delay=self.reconnect_min_delay, max_delay=self.reconnect_max_delay)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
         self.client = client
+        try:
+            client.connect(self.broker, self.port)
+        except Exception as e:
+            # The network loop keeps retrying, messages are spooled meanwhile
+            logger.warning(f"Not possible to connect to mqtt broker {self.broker}:{self.port}. Exception " + str(e))
+            return
+        if self.publisher == False:
+            # No network loop runs yet to read the broker answer. on_connect only marks the client
+            # connected once the broker accepted it, until then messages are spooled
+            deadline = time.monotonic() + self.connect_timeout
+            while self.connected == False and time.monotonic() < deadline:
+                if client.loop(timeout=0.5) != 0:
+                    break
         
\ No newline at end of file
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+
+class OfflineSpool():
+    """
+    Holds the messages published while the broker is unreachable. Only the latest
+    message per topic is kept. Above memory_size topics the oldest ones spill to
+    spool_file (json lines) when configured, otherwise they are dropped.
+    """
+
+    memory_size = 1000
+    spool_file = None
+
+    def __init__(self, memory_size: int = None, spool_file: str = None):
+        if memory_size != None:
+            self.memory_size = int(memory_size)
+        if spool_file != None:
+            self.spool_file = spool_file
+        self.lock = threading.Lock()
+        # topic -> (message, qos, retain), ordered by last update
+        self.memory = OrderedDict()
+        self.spilled = 0
+        self.dropped = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.memory) + self.spilled
+
+    def put(self, topic: str, message: str, qos: int = 0, retain: bool = False):
+        with self.lock:
+            if topic in self.memory:
+                del self.memory[topic]
+            self.memory[topic] = (message, qos, retain)
+            if len(self.memory) > self.memory_size:
+                oldest_topic, oldest = self.memory.popitem(last=False)
+                self.spill(oldest_topic, *oldest)
+
+    def spill(self, topic: str, message: str, qos: int, retain: bool):
+        if self.spool_file == None:
+            self.dropped += 1
+            return
+        spool_dir = os.path.dirname(os.path.realpath(self.spool_file))
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+        with open(self.spool_file, "a") as my_file:
+            my_file.write(json.dumps([topic, message, qos, retain]) + "\n")
+        self.spilled += 1
+
+    def load(self):
+        # Messages spilled by a previous run are replayed as well
+        if self.spool_file != None and os.path.exists(self.spool_file):
+            with self.lock:
+                with open(self.spool_file) as my_file:
+                    self.spilled = sum(1 for line in my_file)
+
+    def drain(self):
+        """
+        Returns and forgets every spooled message as (topic, message, qos, retain),
+        oldest first and with only the latest message per topic.
+        """
+        with self.lock:
+            messages = OrderedDict()
+            if self.spool_file != None and os.path.exists(self.spool_file):
+                with open(self.spool_file) as my_file:
+                    for line in my_file:
+                        try:
+                            topic, message, qos, retain = json.loads(line)
+                        except ValueError:
+                            logger.warning(f"Ignoring corrupted line at {self.spool_file}")
+                            continue
+                        if topic in messages:
+                            del messages[topic]
+                        messages[topic] = (message, qos, retain)
+                os.remove(self.spool_file)
+            for topic, value in self.memory.items():
+                if topic in messages:
+                    del messages[topic]
+                messages[topic] = value
+            self.memory = OrderedDict()
+            self.spilled = 0
+        return [(topic, message, qos, retain) for topic, (message, qos, retain) in messages.items()]
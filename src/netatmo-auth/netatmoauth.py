@@ -2,9 +2,9 @@
 import requests
 import json
 import os
+import time
 import logging
-from lxml import html
-import pickle
+from netatmo_api.token_store import get_token_store, get_default_token_file, default_token_dir
 
 logging.basicConfig(level=logging.INFO)
 
@@ -21,14 +21,16 @@ logger.propagate = False
 class NetatmoAuth():
 
     endpoint = "https://api.netatmo.com"
-    cookies_file = os.path.realpath(os.path.dirname(__file__)) + "/tmp/cookies.tmp"
+    token_dir = default_token_dir
+    # Seconds before expiry at which a stored token is no longer reused
+    refresh_margin = 300
     token = None
     access_token = None
     session = None
     redirect_uri = None
     scopes = "read_station read_thermostat write_thermostat read_camera write_camera access_camera read_presence access_presence read_smokedetector read_homecoach"
 
-    def __init__(self, client_id, client_secret, username, password, endpoint: str ="https://api.netatmo.com", scopes: str =None, access_token: str = None, redirect_uri: str =None, refresh_token: str = None):
+    def __init__(self, client_id, client_secret, username, password, endpoint: str ="https://api.netatmo.com", scopes: str =None, access_token: str = None, redirect_uri: str =None, refresh_token: str = None, token_file: str = None):
         logger.info("Init")
         self.endpoint = endpoint
         self.client_id = client_id
@@ -41,6 +43,9 @@ class NetatmoAuth():
             self.scopes = scopes
         if access_token != None:
             self.access_token = access_token
+        if token_file == None:
+            token_file = get_default_token_file(username, self.token_dir)
+        self.token_store = get_token_store(token_file)
 
     def get_token(self):
         login_headers = self.get_session_headers()
@@ -67,109 +72,82 @@ class NetatmoAuth():
         return XSRF_TOKEN
 
     def get_session_headers(self, username=None, password=None):
+        if username == None:
+            username = self.username
+        if password == None:
+            password = self.password
+        # Processes sharing the token store wait for the login in progress and reuse its token
+        with self.token_store.locked():
+            credentials = self.token_store.get_fresh(self.refresh_margin)
+            if credentials != None:
+                logger.info("Obtained credentials from cache")
+                return self.get_bearer_headers(credentials["access_token"])
+            headers = self.login(username, password)
+            access_token = headers["Authorization"].split(" ")[1]
+            self.token_store.save(access_token, self.get_access_token_expires_at(self.session.cookies))
+        return headers
+
+    def login(self, username, password):
         headers = {
             "User-Agent": "netatmo-home"
             }
-        successful = False   
         if self.session == None:
             session = requests.Session()
             self.session = session
         else:
             session = self.session
-        if os.path.exists(self.cookies_file):
-            with open(self.cookies_file, "rb") as my_file:
-                my_session_cookies = pickle.load(my_file)
-            self.session.cookies = my_session_cookies
-            """
-            check if we got a valid session cookie
-            """
-            req1 = self.session.get("https://auth.netatmo.com/access/csrf")
-            if req1.status_code == 200:
-                token_data = json.loads(req1.text)
-                token = token_data["token"]
-                try:
-                    headers = self.get_access_token_from_cookie(self.session.cookies)
-                except Exception as e:
-                    logger.warning("Error " + str(e))
-                    logger.info(f"Removing {self.cookies_file}")
-                    os.remove(self.cookies_file)
-                if os.path.exists(self.cookies_file):
-                    req2 = self.session.get("https://app.netatmo.net/api/homesdata", headers=headers)
-                    if req2.status_code == 200:
-                        logger.info("Obtained credentials from cache")
-                        successful = True
-                    else:
-                        logger.info(f"Removing {self.cookies_file}")
-                        os.remove(self.cookies_file)
-            else:
-                logger.info(f"Removing {self.cookies_file}")
-                os.remove(self.cookies_file)
-        if successful == False:
-            logger.info("Required to re-authenticate to obtain new credentials")
-            req = self.session.get("https://auth.netatmo.com/en-us/access/login", headers=headers)
-            if req.status_code != 200:
-                logger.error("Unable to contact https://auth.netatmo.com/en-us/access/login")
-                logger.critical("Error: {0}".format(req.status_code))
-                raise Exception("Error: {0}".format(req.status_code))
-                #sys.exit(-1)
-            else:
-                logger.info("Successfully got session cookie from https://auth.netatmo.com/en-us/access/login")
-            req2 = self.session.get("https://auth.netatmo.com/access/csrf")
-            if req2.status_code == 200:
-                token_data = json.loads(req2.text)
-                token = token_data["token"]
-            else:
-                logger.warning("Problem obtaining session token")
-                raise Exception("Problem obtaining session token")
-                # sys.exit(-1)
-            payload = {'email': username,
-                    'password': password,
-                    "stay_logged": "on",
-                    #"website": "",
-                    '_token': token } 
-
-            param = { 'next_url' : 'https://my.netatmo.com/app/energy' }
-            req3 = self.session.post("https://auth.netatmo.com/access/postlogin", params=param, data=payload, headers=headers)
-            headers = self.get_access_token_from_cookie(self.session.cookies)
-            req4 = self.session.get("https://app.netatmo.net/api/homesdata", headers=headers)
-            if req4.status_code == 200:
-                logger.info("Successfully obtained credentials")
-            else:
-                logger.error("Error obtaining credentials")
-                raise Exception("Error obtaining credentials")
-            my_session_cookies = self.session.cookies
-            temp_dir = os.path.realpath(os.path.dirname(self.cookies_file)) 
-            if not os.path.exists(temp_dir):
-                logger.info(f"Creating {temp_dir}")
-                os.makedirs(temp_dir)
-            #my_session_serialized_cookies = pickle.dumps(my_session_cookies)
-            with open(self.cookies_file, "wb") as my_file:
-                pickle.dump(my_session_cookies, my_file)
-                logger.info(f"Persisted session cookies at {self.cookies_file}")
-                successful = True
-        #loginpage = html.fromstring(req.text)
-        #token = loginpage.xpath('//input[@name="_token"]/@value')
-
-        if successful == False:
-            logger.critical("No _token value found in response from https://auth.netatmo.com/en-us/access/login")
-            raise Exception("No _token value found in response from https://auth.netatmo.com/en-us/access/login")
-            #sys.exit(-1)
+        logger.info("Required to re-authenticate to obtain new credentials")
+        req = self.session.get("https://auth.netatmo.com/en-us/access/login", headers=headers)
+        if req.status_code != 200:
+            logger.error("Unable to contact https://auth.netatmo.com/en-us/access/login")
+            logger.critical("Error: {0}".format(req.status_code))
+            raise Exception("Error: {0}".format(req.status_code))
         else:
-            logger.debug("Found _token value {0} in response from https://auth.netatmo.com/en-us/access/login".format(token))
+            logger.info("Successfully got session cookie from https://auth.netatmo.com/en-us/access/login")
+        req2 = self.session.get("https://auth.netatmo.com/access/csrf")
+        if req2.status_code == 200:
+            token_data = json.loads(req2.text)
+            token = token_data["token"]
+        else:
+            logger.warning("Problem obtaining session token")
+            raise Exception("Problem obtaining session token")
+        payload = {'email': username,
+                'password': password,
+                "stay_logged": "on",
+                '_token': token } 
+
+        param = { 'next_url' : 'https://my.netatmo.com/app/energy' }
+        req3 = self.session.post("https://auth.netatmo.com/access/postlogin", params=param, data=payload, headers=headers)
+        headers = self.get_access_token_from_cookie(self.session.cookies)
+        req4 = self.session.get("https://app.netatmo.net/api/homesdata", headers=headers)
+        if req4.status_code == 200:
+            logger.info("Successfully obtained credentials")
+        else:
+            logger.error("Error obtaining credentials")
+            raise Exception("Error obtaining credentials")
         return headers
-        
+
+    def get_access_token_expires_at(self, cookies):
+        for cookie in cookies:
+            if cookie.name == "netatmocomaccess_token" and cookie.expires != None:
+                return cookie.expires
+        # https://dev.netatmo.com/apidocumentation/oauth access tokens last 3 hours
+        return time.time() + 10800
+
     def get_access_token_from_cookie(self, cookies):
         session_cookies = cookies.get_dict()
         if "netatmocomaccess_token" in session_cookies:
             access_token = session_cookies["netatmocomaccess_token"].replace("%7C","|")
-            authentication_value = f"Bearer {access_token}"
         else:
             raise Exception("Error with access token")
+        return self.get_bearer_headers(access_token)
+
+    def get_bearer_headers(self, access_token):
         headers = {
             "User-Agent": "netatmo-home",
             "Accept": "application/json",
             "Content-Type": "application/json",
-            "Authorization": authentication_value
+            "Authorization": f"Bearer {access_token}"
         }
         return headers
             
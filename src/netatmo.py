@@ -8,14 +8,19 @@ import logging
 import time
 import datetime
 import argparse
+import csv
+import hashlib
 import datetime
-from collections import deque
+import threading
+import itertools
 from enum import Enum
-from apscheduler.schedulers.background import BackgroundScheduler
-from jinja2 import Template
-from netatmo_api import Netatmo_API
-from mqtt import MQTT
-from web import launch_fastapp
+# asyncio, apscheduler, jinja2, aiohttp, sqlite3 (history) and the web stack (fastapi, uvicorn) are
+# imported by the modes that use them, paho and prometheus_client on first use: one-shot commands
+# start without loading them
+from netatmo_api import Netatmo_API, PRIORITY_COMMAND
+from mqtt import MQTT, CommandDispatcher, EventLog
+from poller import AdaptiveInterval, StateSnapshot
+from metrics import timed_command, POLL_SECONDS, POLL_FAILURES, POLL_ENTITIES, POLL_LAST_SUCCESS, POLL_INTERVAL
 
 # logging.basicConfig(format='%(levelname)-8s [%(filename)s:%(lineno)d] - %(message)s',
 #     datefmt='%Y-%m-%d:%H:%M:%S',
@@ -48,18 +53,56 @@ class MyNetatmo():
         }
     http_port = 8000
     http_host = "0.0.0.0"
-    mqtt_receive_queue = deque(maxlen=30)
-    mqtt_sent_queue = deque(maxlen=30)
+    http_command_workers = None
+    http_command_timeout = None
+    event_log_size = None
+    history = None
     access_token = None
     refresh_token = None
-
-    def __init__(self, settings_file: str = None):
+    token_file = None
+    redirect_uri = None
+    netatmo = None
+    async_netatmo = None
+    event_loop = None
+    concurrency = None
+    pool_size = None
+    timeout = None
+    token_refresh_margin = None
+    topology_ttl = None
+    measure_cache_dir = None
+    measure_concurrency = None
+    topology_response = None
+    topology_index = None
+    optimistic_commands = False
+    confirm_delay = 5
+    poll_job_id = "get_netatmo_status"
+    poll_fingerprint = None
+    # Homes whose homestatus failed in the last poll, "homesdata" when the whole poll failed
+    failed_homes = []
+    # Fields whose change makes the poller speed up: modes and setpoints, not the sensor readings
+    change_fields = {
+        "homes": ["therm_mode", "cooling_mode"],
+        "rooms": ["therm_setpoint_mode", "therm_setpoint_temperature", "open_window"],
+        "modules": []
+    }
+    openhab_basedir = "/etc/openhab"
+    openhab_templates_dir = None
+    openhab_generate = False
+    openhab_generator = None
+    netatmo_lock = threading.Lock()
+
+    def __init__(self, settings_file: str = None, account: str = None, shared: dict = None, config: configparser.ConfigParser = None):
+        # account selects an [account:<name>] section, shared holds the resources of the other accounts of the process
         if settings_file == None:
             self.settings_file = sys.argv[0].replace(".py", ".ini")
         else:
             self.settings_file = settings_file
-        config = self.get_settings_file(self.settings_file)
+        if config == None:
+            config = self.get_settings_file(self.settings_file)
         self.config = config
+        self.account = account
+        # Label of the poll metrics
+        self.metrics_account = account if account != None else "default"
         # Logging 
         if "severity" in config["logging"]:
             severity = config["logging"]["severity"]
@@ -74,26 +117,39 @@ class MyNetatmo():
         else:
             logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] - %(message)s', datefmt='%Y-%m-%d:%H:%M:%S', level=severity, filename=filename)
         # Credentials
-        self.client_id = config["credentials"]["client_id"]
-        self.client_secret = config["credentials"]["client_secret"]
-        self.username = config["credentials"]["username"]
-        self.password = config["credentials"]["password"]
-        if "access_token" in config["credentials"]:
-            self.access_token = config["credentials"]["access_token"]
-        if "refresh_token" in config["credentials"]:
-            self.refresh_token = config["credentials"]["refresh_token"]
-        if "redirect_uri" in config["credentials"]:
-            self.redirect_uri = config["credentials"]["redirect_uri"]
+        if account == None:
+            credentials = config["credentials"]
+        else:
+            credentials = config[f"account:{account}"]
+        self.client_id = credentials["client_id"]
+        self.client_secret = credentials["client_secret"]
+        self.username = credentials["username"]
+        self.password = credentials["password"]
+        if "access_token" in credentials:
+            self.access_token = credentials["access_token"]
+        if "refresh_token" in credentials:
+            self.refresh_token = credentials["refresh_token"]
+        if "redirect_uri" in credentials:
+            self.redirect_uri = credentials["redirect_uri"]
+        if "token_file" in credentials:
+            # Relative to the settings file, not to the working directory of the process
+            self.token_file = os.path.join(os.path.dirname(os.path.realpath(self.settings_file)), credentials["token_file"])
         try:
-            self.scopes = config["credentials"]["scopes"]
+            self.scopes = credentials["scopes"]
         except:
             self.scopes = None
 
         # Settings home section
-        self.home_id = config["home"]["home_id"]
+        if account == None:
+            self.home_id = config["home"]["home_id"]
+        else:
+            self.home_id = credentials.get("home_id")
 
         # Settings mqtt
         self.topic =  config["mqtt"]["topic"]
+        if account != None:
+            self.topic = f"{self.topic}/{account}"
+            self.poll_job_id = f"get_netatmo_status_{account}"
         self.broker = config["mqtt"]["broker"]
         self.port  = int(config["mqtt"]["port"])
         self.mqtt_settings = {
@@ -101,17 +157,115 @@ class MyNetatmo():
             "broker": self.broker,
             "port": self.port
         }
-        self.mqtt = MQTT(**self.mqtt_settings )
+        if "publisher" in config["mqtt"]:
+            self.mqtt_settings["publisher"] = config["mqtt"].getboolean("publisher")
+        if "qos" in config["mqtt"]:
+            self.mqtt_settings["qos"] = int(config["mqtt"]["qos"])
+        if "retain" in config["mqtt"]:
+            self.mqtt_settings["retain"] = config["mqtt"].getboolean("retain")
+        if "max_inflight" in config["mqtt"]:
+            self.mqtt_settings["max_inflight"] = int(config["mqtt"]["max_inflight"])
+        for setting in ["spool_size", "reconnect_min_delay", "reconnect_max_delay"]:
+            if setting in config["mqtt"]:
+                self.mqtt_settings[setting] = int(config["mqtt"][setting])
+        if "spool_file" in config["mqtt"]:
+            self.mqtt_settings["spool_file"] = config["mqtt"]["spool_file"]
+        if "publish_mode" in config["mqtt"]:
+            self.mqtt_settings["publish_mode"] = config["mqtt"]["publish_mode"]
+        if "delta" in config["mqtt"]:
+            self.mqtt_settings["delta"] = config["mqtt"].getboolean("delta")
+        if "resync_interval" in config["mqtt"]:
+            self.mqtt_settings["resync_interval"] = int(config["mqtt"]["resync_interval"])
+        # Created on first use (get_mqtt), one-shot commands that never publish do not load the spool
+        if shared != None:
+            self.mqtt = shared["mqtt"]
+        dispatcher_settings = {}
+        if "command_workers" in config["mqtt"]:
+            dispatcher_settings["workers"] = int(config["mqtt"]["command_workers"])
+        if "command_queue_size" in config["mqtt"]:
+            dispatcher_settings["max_pending"] = int(config["mqtt"]["command_queue_size"])
+        if "command_coalesce_delay" in config["mqtt"]:
+            dispatcher_settings["coalesce_delay"] = float(config["mqtt"]["command_coalesce_delay"])
+        if shared == None:
+            self.command_dispatcher = CommandDispatcher(self.run_command, **dispatcher_settings)
+        else:
+            self.command_dispatcher = shared["command_dispatcher"]
+        if "event_log_size" in config["mqtt"]:
+            self.event_log_size = int(config["mqtt"]["event_log_size"])
+        # Both logs share the sequence so that a cursor works across them
+        event_sequence = itertools.count(1)
+        self.mqtt_receive_log = EventLog(capacity=self.event_log_size, sequence=event_sequence)
+        self.mqtt_sent_log = EventLog(capacity=self.event_log_size, sequence=event_sequence)
 
         # Settings scheduler
         self.frequency = int(config["global"]["frequency"])
+        poll_settings = {
+            "interval": self.frequency * 60
+        }
+        if "min_frequency" in config["global"]:
+            poll_settings["min_interval"] = float(config["global"]["min_frequency"]) * 60
+        if "max_frequency" in config["global"]:
+            poll_settings["max_interval"] = float(config["global"]["max_frequency"]) * 60
+        if "boost_duration" in config["global"]:
+            poll_settings["boost_duration"] = float(config["global"]["boost_duration"])
+        self.poll_interval = AdaptiveInterval(**poll_settings)
+        # Pre-serialized state served by the web server
+        self.state_snapshot = StateSnapshot()
+
+        # Settings netatmo http client
+        if "pool_size" in config["global"]:
+            self.pool_size = int(config["global"]["pool_size"])
+        if "timeout" in config["global"]:
+            self.timeout = float(config["global"]["timeout"])
+        if "concurrency" in config["global"]:
+            self.concurrency = int(config["global"]["concurrency"])
+        if "token_refresh_margin" in config["global"]:
+            self.token_refresh_margin = int(config["global"]["token_refresh_margin"])
+        if "topology_ttl" in config["global"]:
+            self.topology_ttl = int(config["global"]["topology_ttl"])
+        if "measure_cache_dir" in config["global"]:
+            self.measure_cache_dir = config["global"]["measure_cache_dir"]
+        if "measure_concurrency" in config["global"]:
+            self.measure_concurrency = int(config["global"]["measure_concurrency"])
+        if "optimistic_commands" in config["global"]:
+            self.optimistic_commands = config["global"].getboolean("optimistic_commands")
+        if "confirm_delay" in config["global"]:
+            self.confirm_delay = int(config["global"]["confirm_delay"])
+
+        # Settings history of readings
+        if shared != None:
+            self.history = shared["history"]
+            self.event_loop = shared["event_loop"]
+        elif "history" in config and config["history"].getboolean("enabled", fallback=False):
+            history_settings = {
+                "retention": {}
+            }
+            if "db_file" in config["history"]:
+                history_settings["db_file"] = config["history"]["db_file"]
+            for resolution, key in [("raw", "raw_retention_days"), ("1m", "minute_retention_days"), ("1h", "hour_retention_days"), ("1d", "day_retention_days")]:
+                if key in config["history"]:
+                    history_settings["retention"][resolution] = float(config["history"][key])
+            from history import HistoryStore
+            self.history = HistoryStore(**history_settings)
+
+        # Settings openhab configuration generated after every poll
+        if "openhab" in config:
+            if "basedir" in config["openhab"]:
+                self.openhab_basedir = config["openhab"]["basedir"]
+            if "templates_dir" in config["openhab"]:
+                self.openhab_templates_dir = config["openhab"]["templates_dir"]
+            self.openhab_generate = config["openhab"].getboolean("generate_on_poll", fallback=False)
 
         # Settings web server
         if "http" in config:
             if "port" in config["http"]:
                 self.http_port = int(config["http"]["port"])
             if "host" in config["http"]:
-                self.http_host = int(config["http"]["host"])
+                self.http_host = config["http"]["host"]
+            if "command_workers" in config["http"]:
+                self.http_command_workers = int(config["http"]["command_workers"])
+            if "command_timeout" in config["http"]:
+                self.http_command_timeout = float(config["http"]["command_timeout"])
                 
 
     def get_settings_file(self, settings_file: str = None):
@@ -135,6 +289,7 @@ class MyNetatmo():
             config["credentials"]["access_token"] = "your_access_token"
             config["credentials"]["refresh_token"] = "your_refresh_token"
             config["credentials"]["redirect_uri"] = "your redirect uri"
+            config["credentials"]["token_file"] = "tmp/token.json"
             config["credentials"]["scopes"] = "read_station read_thermostat write_thermostat read_camera write_camera access_camera read_presence access_presence read_smokedetector read_homecoach"
             config["home"] = {}
             config["home"]["home_id"] = "your_home_id"
@@ -142,11 +297,47 @@ class MyNetatmo():
             config["mqtt"]["topic"] = "netatmo2mqtt"
             config["mqtt"]["broker"] = "127.0.0.1"
             config["mqtt"]["port"] = "1883"
+            config["mqtt"]["publish_mode"] = "json"
+            config["mqtt"]["delta"] = "false"
+            config["mqtt"]["publisher"] = "false"
+            config["mqtt"]["qos"] = "0"
+            config["mqtt"]["retain"] = "false"
+            config["mqtt"]["max_inflight"] = "20"
+            config["mqtt"]["spool_size"] = "1000"
+            config["mqtt"]["reconnect_min_delay"] = "1"
+            config["mqtt"]["reconnect_max_delay"] = "120"
+            config["mqtt"]["resync_interval"] = "3600"
+            config["mqtt"]["command_workers"] = "2"
+            config["mqtt"]["command_queue_size"] = "100"
+            config["mqtt"]["event_log_size"] = "1000"
+            config["mqtt"]["command_coalesce_delay"] = "1"
             config["global"] = {}
             config["global"]["frequency"] = "5"
+            config["global"]["min_frequency"] = "1"
+            config["global"]["max_frequency"] = "15"
+            config["global"]["pool_size"] = "10"
+            config["global"]["timeout"] = "15"
+            config["global"]["concurrency"] = "20"
+            config["global"]["topology_ttl"] = "3600"
+            config["global"]["measure_cache_dir"] = "tmp/measures"
+            config["global"]["measure_concurrency"] = "4"
+            config["global"]["optimistic_commands"] = "false"
+            config["global"]["confirm_delay"] = "5"
+            config["history"] = {}
+            config["history"]["enabled"] = "false"
+            config["history"]["db_file"] = "tmp/history.sqlite"
+            config["history"]["raw_retention_days"] = "7"
+            config["history"]["minute_retention_days"] = "30"
+            config["history"]["hour_retention_days"] = "365"
+            config["history"]["day_retention_days"] = "0"
+            config["openhab"] = {}
+            config["openhab"]["basedir"] = "/etc/openhab"
+            config["openhab"]["generate_on_poll"] = "false"
             config["http"] = {}
             config["http"]["port"] = "5"
             config["http"]["host"] = "0.0.0.0"
+            config["http"]["command_workers"] = "4"
+            config["http"]["command_timeout"] = "30"
             config["logging"] = {}
             config["logging"]["severity"] = "INFO"
             config["logging"]["filename"] = "netatmo.log"
@@ -156,191 +347,566 @@ class MyNetatmo():
 
     def background_daemon(self):
         topic = f"{self.topic}/+/+/command"
-        self.mqtt.subscribe_topic(topic=topic, on_message=self.mqtt_on_message)
+        self.command_dispatcher.start()
+        self.get_mqtt().subscribe_topic(topic=topic, on_message=self.mqtt_on_message)
 
     def schedule_daemon(self, webserver=False):
+        from apscheduler.schedulers.background import BackgroundScheduler
         if self.scheduler == None:
             self.scheduler = BackgroundScheduler()
         logger.info(f"Schedule daemon with frequency={self.frequency}")
-        self.scheduler.add_job(self.get_netatmo_status, "interval", minutes=self.frequency, next_run_time=datetime.datetime.now())
+        self.get_netatmo_session().token_manager.set_scheduler(self.scheduler)
+        self.add_poll_job()
         if webserver == True:
+            from web import launch_fastapp
             logger.info(f"Launch Web server at http://{self.http_host}:{self.http_port}")
-            web_config = {
-                "config": self.config,
-                "instance": self
-            }
-            web_params = {
-                "host": self.http_host,
-                "port": self.http_port,
-                "settings": web_config
-            }
-            self.scheduler.add_job(launch_fastapp, kwargs=web_params)
+            self.scheduler.add_job(launch_fastapp, kwargs=self.get_web_params())
         self.scheduler.start()
         self.background_daemon()
 
+    def add_poll_job(self, delay: float = 0):
+        # delay (seconds) postpones the first poll, to spread the accounts of a process over time
+        next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.scheduler.add_job(self.poll_netatmo_status, "interval", seconds=self.poll_interval.get_interval(), next_run_time=next_run_time, id=self.poll_job_id)
+
+    def get_web_params(self, accounts: dict = None):
+        web_config = {
+            "config": self.config,
+            "instance": self
+        }
+        if accounts != None:
+            web_config["accounts"] = accounts
+        if self.http_command_workers != None:
+            web_config["command_workers"] = self.http_command_workers
+        if self.http_command_timeout != None:
+            web_config["command_timeout"] = self.http_command_timeout
+        web_params = {
+            "host": self.http_host,
+            "port": self.http_port,
+            "settings": web_config
+        }
+        return web_params
+
+    def get_shared(self):
+        # Resources the other accounts of the process reuse instead of creating their own
+        shared = {
+            "mqtt": self.get_mqtt(),
+            "command_dispatcher": self.command_dispatcher,
+            "history": self.history,
+            "event_loop": self.get_event_loop()
+        }
+        return shared
+
     def mqtt_on_message(self, client, userdata, message):
         if not message.topic.endswith("/state"):
-            item = message.topic.split("/")[1]
-            topic = message.topic.split("/")[2]
+            # <topic>/<item>/<command>/command, the base topic may have several levels
+            item, topic = message.topic[len(self.topic) + 1:].split("/")[0:2]
             value = message.payload.decode()
             timestamp = time.time()
             logger.info(f"message received {message.payload} value={value} fulltopic={message.topic} qos={message.qos} flag={message.retain} item={item} topic={topic}")
-            payload = {
-                "topic": topic,
-                "item": item,
-                "payload": value,
-                "timestamp": timestamp
-            }
-            self.mqtt_receive_queue.appendleft(payload)
-            if topic == "therm_mode":
-                self.setthermmode(mode=value)
-            if topic == "truetemperature":
-                try:
-                    self.truetemperature(item, float(value))
-                except Exception as e:
-                    logger.error("Exception " + str(e))
+            self.mqtt_receive_log.append(item, topic, value, timestamp)
+            # Never block the paho network thread with netatmo calls
+            self.command_dispatcher.submit(item, topic, value, handler=self.run_command)
+
+    def run_command(self, item: str, topic: str, value: str):
+        if topic == "therm_mode":
+            self.setthermmode(mode=value)
+        if topic == "truetemperature":
+            self.truetemperature(item, float(value))
+
+    def get_mqtt_events(self, mode: str = "both", item: str = None, since: float = None, limit: int = 100, cursor: int = None):
+        # Newest first across the selected logs, next_cursor fetches the following page
+        query = {"item": item, "since": since, "limit": limit, "cursor": cursor}
+        received = []
+        sent = []
+        if mode in ["inbound", "both"]:
+            received = self.mqtt_receive_log.query(**query)
+        if mode in ["outbound", "both"]:
+            sent = self.mqtt_sent_log.query(**query)
+        page = sorted(received + sent, key=lambda event: event["sequence"], reverse=True)[:limit]
+        next_cursor = None
+        if len(page) == limit:
+            next_cursor = page[-1]["sequence"]
+        received_sequences = set([event["sequence"] for event in received])
+        payload = {
+            "mqtt_receive_queue": [event for event in page if event["sequence"] in received_sequences],
+            "mqtt_send_queue": [event for event in page if event["sequence"] not in received_sequences],
+            "next_cursor": next_cursor
+        }
+        return payload
+
+    def getroommeasure(self, room_id: str, scale: str = "30min", types: list = None, date_begin: int = None, date_end: int = None):
+        netatmo = self.get_netatmo_session()
+        return netatmo.getroommeasure(room_id, scale=scale, types=types, date_begin=date_begin, date_end=date_end)
+
+    def get_history(self, entity_id: str, start: float = None, end: float = None, resolution: str = "auto", field: str = None):
+        if self.history == None:
+            return None
+        return self.history.query(entity_id, start=start, end=end, resolution=resolution, field=field)
+
+    def get_command_status(self):
+        return self.command_dispatcher.get_stats()
 
     def scheduler_status(self):
         return self.scheduler.running
 
-    def get_netatmo_session(self):
-        config = self.get_settings_file(self.settings_file)
-        netatmo = Netatmo_API(self.client_id, self.client_secret,
-                            self.username, self.password, scopes=self.scopes, access_token=self.access_token, redirect_uri=self.redirect_uri, refresh_token=self.refresh_token)
-        return netatmo
+    def poll_netatmo_status(self):
+        # Scheduled poll: feeds the adaptive interval with errors and detected changes
+        netatmo = self.get_netatmo_session()
+        netatmo.reset_errors()
+        try:
+            all_data = self.get_netatmo_status()
+        except Exception as e:
+            logger.error("Exception polling netatmo status " + str(e))
+            POLL_FAILURES.labels(self.metrics_account).inc()
+            self.poll_interval.on_error(rate_limited=netatmo.rate_limited)
+        else:
+            if netatmo.last_error_status != None or self.failed_homes != []:
+                logger.warning(f"Incomplete poll failed_homes={self.failed_homes} last_error_status={netatmo.last_error_status}")
+                POLL_FAILURES.labels(self.metrics_account).inc()
+                self.poll_interval.on_error(rate_limited=netatmo.rate_limited)
+            else:
+                POLL_LAST_SUCCESS.labels(self.metrics_account).set_to_current_time()
+                self.poll_interval.on_success(changed=self.detect_changes(all_data))
+        self.reschedule_poll()
+
+    def get_poll_fingerprint(self, all_data: dict):
+        # Entities and their change_fields only: a new temperature or battery level is not a change
+        state = []
+        for kind, fields in self.change_fields.items():
+            for entity in all_data.get(kind, []):
+                state.append([kind, entity.get("id")] + [entity.get(field) for field in fields])
+        return hashlib.sha1(json.dumps(state, default=str).encode()).hexdigest()
+
+    def detect_changes(self, all_data: dict):
+        fingerprint = self.get_poll_fingerprint(all_data)
+        changed = self.poll_fingerprint != None and fingerprint != self.poll_fingerprint
+        self.poll_fingerprint = fingerprint
+        return changed
+
+    def reschedule_poll(self):
+        interval = self.poll_interval.get_interval()
+        POLL_INTERVAL.labels(self.metrics_account).set(interval)
+        if self.scheduler != None and self.scheduler.get_job(self.poll_job_id) != None:
+            job = self.scheduler.get_job(self.poll_job_id)
+            if job.trigger.interval.total_seconds() != interval:
+                logger.info(f"Next netatmo polls every {interval} seconds")
+                self.scheduler.reschedule_job(self.poll_job_id, trigger="interval", seconds=interval)
+        return interval
+
+    def on_command(self):
+        # Poll faster for a while so that the effect of a command shows up soon
+        self.poll_interval.on_command()
+        if self.scheduler != None and self.scheduler.get_job(self.poll_job_id) != None:
+            interval = self.poll_interval.get_interval()
+            self.scheduler.reschedule_job(self.poll_job_id, trigger="interval", seconds=interval)
+
+    def get_scheduler_status(self):
+        status = self.poll_interval.get_stats()
+        status["running"] = self.scheduler != None and self.scheduler.running
+        status["next_run_time"] = None
+        if self.scheduler != None and self.scheduler.get_job(self.poll_job_id) != None:
+            status["next_run_time"] = self.scheduler.get_job(self.poll_job_id).next_run_time
+        return status
+
+    def get_mqtt(self):
+        # Shared by polls, commands and web requests, created (spool loaded) on first use
+        with self.netatmo_lock:
+            if self.mqtt == None:
+                self.mqtt = MQTT(**self.mqtt_settings)
+        return self.mqtt
 
-    def get_netatmo_status(self):
+    def get_netatmo_session(self):
+        # Long lived client shared by polls, mqtt commands and web requests
+        with self.netatmo_lock:
+            if self.netatmo == None:
+                # The home_id of an [account:<name>] restricts its polls and commands to that home.
+                # [home] home_id of a single account was never applied, it is left out not to change its polls
+                home_id = self.home_id if self.account != None else None
+                self.netatmo = Netatmo_API(self.client_id, self.client_secret,
+                                    self.username, self.password, home_id=home_id, scopes=self.scopes, access_token=self.access_token, redirect_uri=self.redirect_uri, refresh_token=self.refresh_token,
+                                    pool_size=self.pool_size, timeout=self.timeout, token_refresh_margin=self.token_refresh_margin,
+                                    topology_ttl=self.topology_ttl, measure_cache_dir=self.measure_cache_dir, measure_concurrency=self.measure_concurrency,
+                                    token_file=self.token_file)
+        return self.netatmo
+
+    def get_async_netatmo_session(self):
+        netatmo = self.get_netatmo_session()
+        with self.netatmo_lock:
+            if self.async_netatmo == None:
+                from netatmo_api import AsyncNetatmoAPI
+                self.async_netatmo = AsyncNetatmoAPI(netatmo, concurrency=self.concurrency)
+        return self.async_netatmo
+
+    def get_event_loop(self):
+        # A single background event loop keeps the aiohttp connection pool alive between polls
+        import asyncio
+        with self.netatmo_lock:
+            if self.event_loop == None:
+                self.event_loop = asyncio.new_event_loop()
+                loop_thread = threading.Thread(target=self.event_loop.run_forever, name="netatmo_event_loop", daemon=True)
+                loop_thread.start()
+        return self.event_loop
+
+    def run_async(self, coroutine):
+        import asyncio
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.get_event_loop())
+        return future.result()
+
+    def get_netatmo_status(self, refresh_topology: bool = False):
         logger.info("Launching get_netatmo_status")
+        started = time.monotonic()
         # self.mqtt.send_message(payload="test", item="test", topic="test", mode="command")
         netatmo = self.get_netatmo_session()
-        homesdata_response = netatmo.homesdata()
+        homesdata_response = netatmo.homesdata(use_cache=not refresh_topology)
+        all_homestatus = {}
+        if homesdata_response != None and "body" in homesdata_response and "homes" in homesdata_response["body"]:
+            home_ids = [homedata["id"] for homedata in homesdata_response["body"]["homes"]]
+            async_netatmo = self.get_async_netatmo_session()
+            all_homestatus = self.run_async(async_netatmo.homestatus_many(home_ids))
+        all_data = self.process_netatmo_status(homesdata_response, all_homestatus)
+        if self.history != None and "homesdata" not in self.failed_homes:
+            # Only the readings of this poll, not the entities kept from the previous one
+            fresh_data = {}
+            for kind in ["rooms", "modules"]:
+                fresh_data[kind] = [entity for entity in all_data[kind] if entity.get("home_id") not in self.failed_homes]
+            try:
+                self.history.record(fresh_data)
+            except Exception as e:
+                logger.error("Exception recording history " + str(e))
+        if self.openhab_generate == True:
+            try:
+                self.get_openhab_generator().generate(all_data)
+            except Exception as e:
+                logger.error("Exception generating openhab files " + str(e))
+        POLL_SECONDS.labels(self.metrics_account).observe(time.monotonic() - started)
+        for kind in ["homes", "rooms", "modules"]:
+            POLL_ENTITIES.labels(self.metrics_account, kind).set(len(all_data[kind]))
+        return all_data
+
+    def invalidate_topology(self):
+        netatmo = self.get_netatmo_session()
+        netatmo.invalidate_topology()
+        self.topology_response = None
+        self.topology_index = None
+
+    def get_topology_index(self, homes: list):
+        # id -> homesdata metadata, built once per homesdata response
+        topology_index = {
+            "rooms": {},
+            "modules": {}
+        }
+        for home in homes:
+            for room in home.get("rooms", []):
+                topology_index["rooms"][room["id"]] = room
+            for module in home.get("modules", []):
+                topology_index["modules"][module["id"]] = module
+        return topology_index
+
+    def merge_room(self, room: dict, home_id: str, topology_index: dict):
+        room["home_id"] = home_id
+        room_item = topology_index["rooms"].get(room["id"])
+        if room_item != None:
+            room.update(room_item)
+        if "module_ids" in room:
+            del room["module_ids"]
+        return room
+
+    def merge_module(self, module: dict, home_id: str, topology_index: dict):
+        module["home_id"] = home_id
+        module_item = topology_index["modules"].get(module["id"])
+        if module_item != None:
+            module.update(module_item)
+            module["label"] = module["id"].replace(":", "")
+        if "setup_date" in module:
+            # "yyyy-MM-dd'T'HH:mm:ss.SSSZ"
+            my_formatted_time = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.localtime(module["setup_date"]))
+            module["setup_date"] = my_formatted_time
+        if "modules_bridged" in module:
+            del module["modules_bridged"]
+        return module
+
+    def process_netatmo_status(self, homesdata_response: dict, all_homestatus: dict):
         all_data = { 
             "homes": [],
             "rooms": [],
             "modules": []
         }
-        all_homes = []
+        events = []
+        failed_homes = []
+        full_cycle = self.get_mqtt().start_cycle(topic=self.topic)
         if homesdata_response != None and "body" in homesdata_response and "homes" in homesdata_response["body"]:
-            for homedata in homesdata_response["body"]["homes"]:
-                my_home_id = homedata["id"]
+            # homesdata may come from the topology cache: index it once and never mutate it
+            if homesdata_response is not self.topology_response:
+                self.topology_index = self.get_topology_index(homesdata_response["body"]["homes"])
+                self.topology_response = homesdata_response
+            topology_index = self.topology_index
+            for home in homesdata_response["body"]["homes"]:
+                my_home_id = home["id"]
+                homedata = {key: value for key, value in home.items() if key not in ["rooms", "modules", "schedules"]}
                 if "coordinates" in homedata and "altitude" in homedata:
                     homedata["coordinates"] = "{0},{1},{2}".format(homedata["coordinates"][0],homedata["coordinates"][1], homedata["altitude"] )
-                all_data["homes"].append(homedata)
-                homestatus_response = netatmo.homestatus(home_id=my_home_id)
+                homestatus_response = all_homestatus.get(my_home_id, {})
+                if "body" not in homestatus_response:
+                    logger.error(f"Not possible to obtain homestatus for home_id={my_home_id}")
+                    failed_homes.append(my_home_id)
+                    # Keep serving the entities of the previous poll instead of an empty home
+                    all_data["rooms"] += [room for room in self.all_data["rooms"] if room.get("home_id") == my_home_id]
+                    all_data["modules"] += [module for module in self.all_data["modules"] if module.get("home_id") == my_home_id]
+                    homestatus_response = {"body": {"home": {}}}
                 if "rooms" in homestatus_response["body"]["home"]:
                     for room in homestatus_response["body"]["home"]["rooms"]:
                         item = room["id"]
-                        room["home_id"] = my_home_id
-                        for home_item in all_data["homes"]:
-                            for room_item in home_item["rooms"]:
-                                if room["id"] == room_item["id"]:
-                                    room = {**room , **room_item}
-                        if "module_ids" in room:
-                            del room["module_ids"]
+                        room = self.merge_room(room, my_home_id, topology_index)
                         all_data["rooms"].append(room)
-                        timestamp = time.time()
-                        event = {"topic": "room", "item": item, "payload": room, "timestamp": timestamp}
-                        self.mqtt_sent_queue.appendleft(event)
-                        self.mqtt.send_message(payload=room, item=item)
+                        events.append(("room", item, room))
                 else:
                     logger.error("Not found any rooms at response")
                 if "modules" in homestatus_response["body"]["home"]:
                     for module in homestatus_response["body"]["home"]["modules"]:
                         item = module["id"]
-                        module["home_id"] = my_home_id
-                        for home_item in all_data["homes"]:
-                            for module_item in home_item["modules"]:
-                                if module["id"] == module_item["id"]:
-                                    module = {**module, **module_item}
-                                    module["label"] = module["id"].replace(":", "")
-                        if "setup_date" in module:
-                            # "yyyy-MM-dd'T'HH:mm:ss.SSSZ"
-                            my_formatted_time = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.localtime(module["setup_date"]))
-                            #my_fomratted_time = datetime.datetime.fromtimestamp(module["setup_date"]).strftime('yyyy-MM-dd'T'HH:mm:ssZ')
-                            module["setup_date"] = my_formatted_time
-                        if "modules_bridged" in module:
-                            del module["modules_bridged"]
+                        module = self.merge_module(module, my_home_id, topology_index)
                         all_data["modules"].append(module)
-                        timestamp = time.time()
-                        event = {"topic": "modules", "item": item, "payload": module, "timestamp": timestamp}
-                        self.mqtt_sent_queue.appendleft(event)
-                        self.mqtt.send_message(payload=module, item=item)
+                        events.append(("modules", item, module))
                 else:
                     logger.error("Not found any modules at response")
-                if "rooms" in homedata:
-                    del homedata["rooms"]
-                if "modules" in homedata:
-                    del homedata["modules"]
-                if "schedules" in homedata:
-                    del homedata["schedules"]
-                timestamp = time.time()
-                event = event = {"topic": "homedata", "item": my_home_id, "payload": homedata, "timestamp": timestamp}
-                self.mqtt_sent_queue.appendleft(event)
-                self.mqtt.send_message(payload=homedata, item=my_home_id)
-                all_homes.append(homedata)
+                events.append(("homedata", my_home_id, homedata))
+                all_data["homes"].append(homedata)
         else:
             logger.warning("No homesdata_response obtained")
-        all_data["homes"] = all_homes
+            failed_homes.append("homesdata")
+            for kind in ["homes", "rooms", "modules"]:
+                all_data[kind] = list(self.all_data[kind])
+        self.failed_homes = failed_homes
+        published = self.get_mqtt().send_states([(item, payload) for topic, item, payload in events], topic=self.topic, full_cycle=full_cycle)
+        timestamp = time.time()
+        for (topic, item, payload), sent in zip(events, published):
+            if sent == True:
+                self.mqtt_sent_log.append(item, topic, payload, timestamp)
         all_data["broker"] = self.broker
         all_data["port"] = self.port
         all_data["topic"] = self.topic
+        all_data["publish_mode"] = self.get_mqtt().publish_mode
         self.all_data = all_data
+        self.state_snapshot.update(all_data)
+        mqtt_stats = self.get_mqtt().get_stats()
+        logger.info(f"Finished get_netatmo_status messages_sent={mqtt_stats['messages_sent']} messages_skipped={mqtt_stats['messages_skipped']}")
         return all_data
 
-    def setthermmode(self, mode="schedule"):
+    @timed_command("setthermmode")
+    def setthermmode(self, mode="schedule", optimistic: bool = None):
         logger.info(f"Triggered setthermmode mode={mode}")
+        self.on_command()
+        if optimistic == None:
+            optimistic = self.optimistic_commands
         netatmo = self.get_netatmo_session()
-        response = netatmo.setthermmode(mode=mode)
+        with netatmo.governor.priority(PRIORITY_COMMAND):
+            if optimistic == False:
+                response = netatmo.setthermmode(mode=mode)
+                return response
+            # Return as soon as the write succeeds, a status fetch confirms it in background
+            if netatmo.home_id != None:
+                home_id = netatmo.home_id
+            else:
+                home_id = netatmo.get_default_home_id()
+            response = netatmo.setthermmode(home_id=home_id, mode=mode, refresh=False)
+        if response.get("status") == "ok":
+            self.update_home_state(home_id, therm_mode=mode)
+            self.schedule_confirmation()
+        else:
+            logger.error(f"setthermmode failed home_id={home_id} mode={mode} response={response}")
         return response
 
+    def update_home_state(self, home_id: str, **fields):
+        for homedata in self.all_data["homes"]:
+            if homedata["id"] == home_id:
+                homedata.update(fields)
+                self.state_snapshot.update(self.all_data)
+                if self.get_mqtt().send_state(payload=homedata, item=home_id, topic=self.topic):
+                    self.mqtt_sent_log.append(home_id, "homedata", homedata, time.time())
+                return homedata
+        return None
+
+    def schedule_confirmation(self):
+        run_date = datetime.datetime.now() + datetime.timedelta(seconds=self.confirm_delay)
+        job_params = {"refresh_topology": True}
+        if self.scheduler != None and self.scheduler.running:
+            self.scheduler.add_job(self.get_netatmo_status, "date", run_date=run_date, kwargs=job_params)
+        else:
+            timer = threading.Timer(self.confirm_delay, self.get_netatmo_status, kwargs=job_params)
+            timer.daemon = True
+            timer.start()
+
+    @timed_command("truetemperature")
     def truetemperature(self, room_id: str, corrected_temperature: float, home_id: str = None):
         logger.info(f"Triggered truetemperature room_id={room_id} corrected_temperature={corrected_temperature}")
+        self.on_command()
         netatmo = self.get_netatmo_session()
-        response = netatmo.set_truetemperature(room_id, corrected_temperature, home_id)
+        with netatmo.governor.priority(PRIORITY_COMMAND):
+            response = netatmo.set_truetemperature(room_id, corrected_temperature, home_id=home_id)
         return response
 
+    def get_governor_status(self):
+        netatmo = self.get_netatmo_session()
+        return netatmo.governor.get_stats()
+
+    def get_openhab_generator(self, openhab_basedir: str = None):
+        # Kept between polls: compiled templates and the hashes of the files already written
+        from openhab import OpenhabGenerator
+        if openhab_basedir == None:
+            openhab_basedir = self.openhab_basedir
+        if self.openhab_generator == None or self.openhab_generator.openhab_basedir != openhab_basedir.rstrip("/"):
+            name = "netatmo" if self.account == None else f"netatmo_{self.account}"
+            self.openhab_generator = OpenhabGenerator(openhab_basedir=openhab_basedir, templates_dir=self.openhab_templates_dir, name=name)
+        return self.openhab_generator
+
     def create_openhab_template(self, openhab_basedir="/etc/openhab"):
         logger.info("Creating openhab template file")
-        if openhab_basedir.endswith("/"):
-            openhab_basedir = openhab_basedir[0:-1]
-        template_things_file = "templates/template_things.j2"
-        template_items_file = "templates/template_items.j2"
-        template_sitemaps_file = "templates/template_sitemaps.j2"
-        with open(template_things_file) as my_file:
-            template_things = my_file.read()
-        with open(template_items_file) as my_file:
-            template_items = my_file.read()
-        with open(template_sitemaps_file) as my_file:
-            template_sitemaps = my_file.read()
-        # Template things
-        template = Template(template_things)
-        data_things = template.render(self.all_data)
-        self.create_openhab_file(openhab_basedir, data_things, mode="things")
-        # Template items
-        template = Template(template_items)
-        data_items = template.render(self.all_data)
-        self.create_openhab_file(openhab_basedir, data_items, mode="items")
-        # Template sitemaps
-        template = Template(template_sitemaps)
-        data_sitemaps = template.render(self.all_data)
-        self.create_openhab_file(openhab_basedir, data_sitemaps, mode="sitemaps")
-        return data_things, data_items, data_sitemaps
-
-    def create_openhab_file(self, openhab_basedir, data, mode="things"):
-        if mode == "sitemaps":
-            extension = "sitemap"
-        else:
-            extension = mode
-        
-        target_file = openhab_basedir + "/" + mode + "/netatmo." + extension
-        if os.path.exists(openhab_basedir + "/" + mode):
-            with open(target_file, "w") as my_file:
-                my_file.write(data)
-            logger.info(f"Created {target_file}")
+        generator = self.get_openhab_generator(openhab_basedir)
+        rendered, changed = generator.generate(self.all_data)
+        logger.info(f"Openhab files changed={changed}")
+        return rendered["things"], rendered["items"], rendered["sitemaps"]
+
+    def export_measures(self, output_file: str, device_id: str, module_id: str = None, scale: str = "max", types: list = None,
+                        date_begin: int = None, date_end: int = None, batch_size: int = 10000):
+        """
+        Streams getmeasure rows to a csv or parquet file (by extension), one page at a time.
+        Parquet needs pyarrow, it is written as row groups of batch_size rows.
+        """
+        if types == None:
+            types = ["Temperature", "Humidity"]
+        netatmo = self.get_netatmo_session()
+        rows = netatmo.getmeasure(device_id, module_id=module_id, scale=scale, types=types, date_begin=date_begin, date_end=date_end)
+        columns = ["timestamp"] + types
+        if output_file.endswith(".parquet"):
+            exported = self.write_parquet(output_file, columns, rows, batch_size)
         else:
-            logger.error(f"openhab basedir {openhab_basedir}/{mode} is not present ")
-            return False
-        return True
+            exported = self.write_csv(output_file, columns, rows)
+        logger.info(f"Exported {exported} measures to {output_file}")
+        return exported
+
+    def write_csv(self, output_file: str, columns: list, rows):
+        exported = 0
+        with open(output_file, "w", newline="") as my_file:
+            writer = csv.writer(my_file)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                exported += 1
+        return exported
+
+    def write_parquet(self, output_file: str, columns: list, rows, batch_size: int):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("Parquet export needs pyarrow. Install it with pip install pyarrow")
+        fields = [pyarrow.field("timestamp", pyarrow.int64())] + [pyarrow.field(column, pyarrow.float64()) for column in columns[1:]]
+        schema = pyarrow.schema(fields)
+        exported = 0
+        batch = []
+        with pyarrow.parquet.ParquetWriter(output_file, schema) as writer:
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    writer.write_table(pyarrow.Table.from_pylist([dict(zip(columns, values)) for values in batch], schema=schema))
+                    exported += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                writer.write_table(pyarrow.Table.from_pylist([dict(zip(columns, values)) for values in batch], schema=schema))
+                exported += len(batch)
+        return exported
+
+class MultiNetatmo():
+    """
+    Serves every [account:<name>] section of the settings file from one process. The
+    accounts share one scheduler and its worker pool, the mqtt connection, the command
+    workers, the history store, the asyncio loop and the web server. Each account keeps
+    its own Netatmo client, adaptive interval and state, publishes under <topic>/<name>
+    and polls on its own job, so a failing account never stops the others. First polls
+    are spread over one poll interval.
+    """
+
+    settings_file = sys.argv[0].replace(".py", ".ini")
+    # Scheduler threads running polls (each poll waits on the network most of the time)
+    poll_workers = 10
+    scheduler = None
+
+    def __init__(self, settings_file: str = None):
+        if settings_file != None:
+            self.settings_file = settings_file
+        config = self.get_settings_file(self.settings_file)
+        self.config = config
+        names = get_account_names(config)
+        if len(names) == 0:
+            raise Exception(f"No [account:<name>] section at {self.settings_file}")
+        if "poll_workers" in config["global"]:
+            self.poll_workers = int(config["global"]["poll_workers"])
+        self.topic = config["mqtt"]["topic"]
+        self.accounts = {}
+        shared = None
+        for name in names:
+            try:
+                account = MyNetatmo(settings_file=self.settings_file, account=name, shared=shared, config=config)
+            except Exception as e:
+                logger.error(f"Ignoring account {name}. Exception " + str(e))
+                continue
+            if shared == None:
+                shared = account.get_shared()
+            self.accounts[name] = account
+        if len(self.accounts) == 0:
+            raise Exception(f"No valid account at {self.settings_file}")
+        self.primary = list(self.accounts.values())[0]
+        logger.info(f"Loaded {len(self.accounts)} netatmo accounts")
+
+    def get_settings_file(self, settings_file: str):
+        if not os.path.exists(settings_file):
+            raise Exception(f"Missing settings file! {settings_file}")
+        config = configparser.ConfigParser()
+        config.read(settings_file)
+        return config
+
+    def schedule_daemon(self, webserver=False):
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from apscheduler.executors.pool import ThreadPoolExecutor
+        executors = {
+            "default": ThreadPoolExecutor(self.poll_workers)
+        }
+        job_defaults = {
+            "coalesce": True,
+            "max_instances": 1
+        }
+        self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+        for index, account in enumerate(self.accounts.values()):
+            account.scheduler = self.scheduler
+            account.get_netatmo_session().token_manager.set_scheduler(self.scheduler)
+            account.add_poll_job(delay=index * account.poll_interval.get_interval() / len(self.accounts))
+        if webserver == True:
+            from web import launch_fastapp
+            logger.info(f"Launch Web server at http://{self.primary.http_host}:{self.primary.http_port}")
+            self.scheduler.add_job(launch_fastapp, kwargs=self.primary.get_web_params(accounts=self.accounts))
+        self.scheduler.start()
+        self.primary.command_dispatcher.start()
+        self.primary.mqtt.subscribe_topic(topic=f"{self.topic}/+/+/+/command", on_message=self.mqtt_on_message)
+
+    def mqtt_on_message(self, client, userdata, message):
+        # <topic>/<account>/<item>/<command>/command goes to the account
+        name = message.topic[len(self.topic) + 1:].split("/")[0]
+        if name not in self.accounts:
+            logger.warning(f"Ignoring mqtt message for unknown account topic={message.topic}")
+            return
+        self.accounts[name].mqtt_on_message(client, userdata, message)
+
+def get_account_names(config: configparser.ConfigParser):
+    return [section.split(":", 1)[1] for section in config.sections() if section.startswith("account:")]
+
+def get_date(value: str):
+    # Unix time or ISO date (2023-01-31 or 2023-01-31T10:00)
+    if value == None:
+        return None
+    if value.isdigit():
+        return int(value)
+    return int(datetime.datetime.fromisoformat(value).timestamp())
 
 def get_flags():
     parser = argparse.ArgumentParser()
@@ -349,6 +915,13 @@ def get_flags():
     parser.add_argument("-d", "--daemon", help="daemon", action="store_true")
     parser.add_argument("-web", "--webserver", help="web server", action="store_true")
     parser.add_argument("-oh", "--openhabtemplate", type=str, help="Create openhab template")
+    parser.add_argument("-gm", "--getmeasure", type=str, help="Export the measures of a weather station or homecoach device_id to --output")
+    parser.add_argument("--module_id", type=str, help="getmeasure module_id of the device (outdoor, wind, rain...)")
+    parser.add_argument("--measure_types", type=str, default="Temperature,Humidity", help="getmeasure comma separated types")
+    parser.add_argument("--scale", type=str, default="max", help="getmeasure scale: max, 30min, 1hour, 3hours, 1day, 1week, 1month")
+    parser.add_argument("--date_begin", type=str, help="getmeasure start, unix time or ISO date (default 1 day ago)")
+    parser.add_argument("--date_end", type=str, help="getmeasure end, unix time or ISO date (default now)")
+    parser.add_argument("-o", "--output", type=str, default="measures.csv", help="getmeasure export file, .csv or .parquet")
     try:
         settings = parser.parse_args()
     except:
@@ -389,6 +962,12 @@ def main():
         opehhab_basedir = flags.openhabtemplate
         netatmo_run.create_openhab_template(openhab_basedir=opehhab_basedir)
 
+    if flags.getmeasure:
+        logger.info(f"Export measures of {flags.getmeasure} to {flags.output}")
+        netatmo_run = MyNetatmo(settings_file=settings_file)
+        netatmo_run.export_measures(flags.output, flags.getmeasure, module_id=flags.module_id, scale=flags.scale, types=flags.measure_types.split(","),
+                                    date_begin=get_date(flags.date_begin), date_end=get_date(flags.date_end))
+
     if flags.webserver:
         webserver = True
     else:
@@ -396,8 +975,13 @@ def main():
 
     if flags.daemon:
         logger.info("Launching daemon")
-        netatmo_run = MyNetatmo(settings_file=settings_file)
-        netatmo_run.get_netatmo_status()
+        config = configparser.ConfigParser()
+        config.read(settings_file if settings_file != None else MyNetatmo.settings_file)
+        if len(get_account_names(config)) > 0:
+            netatmo_run = MultiNetatmo(settings_file=settings_file)
+        else:
+            netatmo_run = MyNetatmo(settings_file=settings_file)
+            netatmo_run.get_netatmo_status()
         netatmo_run.schedule_daemon(webserver=webserver)
        
     return None
@@ -1 +1,12 @@
-from .netatmo_api import *
\ No newline at end of file
+from .netatmo_api import *
+from .governor import RequestGovernor, get_governor, PRIORITY_COMMAND, PRIORITY_POLL, PRIORITY_BACKFILL
+from .measure_cache import MeasureCache
+from .singleflight import SingleFlight
+from .token_store import TokenStore, get_token_store, get_default_token_file
+
+def __getattr__(name):
+    # aiohttp is only loaded by the polls of the daemon, not by the one-shot commands
+    if name == "AsyncNetatmoAPI":
+        from .async_netatmo_api import AsyncNetatmoAPI
+        return AsyncNetatmoAPI
+    raise AttributeError(f"module {__name__} has no attribute {name}")
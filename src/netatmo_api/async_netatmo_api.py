@@ -0,0 +1,201 @@
+#!/bin/python3
+import asyncio
+import aiohttp
+import json
+import os
+import logging
+import time
+from .netatmo_api import Netatmo_API
+from metrics import observe_api_request
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+class AsyncNetatmoAPI():
+    """
+    asyncio counterpart of Netatmo_API. Authentication is delegated to the
+    wrapped Netatmo_API instance so both clients share the same token.
+    """
+
+    # Enough for the homes of a typical account to be fetched in one round
+    concurrency = 20
+    session = None
+    semaphore = None
+
+    def __init__(self, netatmo: Netatmo_API, concurrency: int = None):
+        logger.info("Init")
+        self.netatmo = netatmo
+        self.endpoint = netatmo.endpoint
+        if concurrency != None:
+            self.concurrency = int(concurrency)
+
+    async def get_client_session(self):
+        # Created lazily so that it binds to the running event loop
+        if self.session == None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=max(self.netatmo.pool_size, self.concurrency))
+            timeout = aiohttp.ClientTimeout(total=self.netatmo.timeout)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def close(self):
+        if self.session != None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def get_token(self):
+        # Read from the token manager, the background refresh does not update netatmo.token
+        token_manager = self.netatmo.token_manager
+        if not token_manager.is_fresh():
+            return await asyncio.to_thread(self.netatmo.get_token)
+        return token_manager.access_token
+
+    def is_token_rejected(self, status: int, content: bytes):
+        # Netatmo error codes 2 (invalid token) and 3 (expired token)
+        if status == 401:
+            return True
+        if status == 403:
+            try:
+                error_code = json.loads(content)["error"]["code"]
+            except Exception:
+                return False
+            return error_code in [2, 3]
+        return False
+
+    def get_query(self, parameters: dict = None):
+        # aiohttp does not expand list values the way requests does
+        query = []
+        if parameters == None:
+            return query
+        for key, value in parameters.items():
+            if isinstance(value, (list, tuple)):
+                for element in value:
+                    query.append((key, str(element)))
+            else:
+                query.append((key, str(value)))
+        return query
+
+    async def api_request(self, method: str, api_name: str, parameters: dict = None, retry: bool = True, body: dict = None):
+        # body is sent as json, for the app api calls (truetemperature) that do not take query parameters
+        endpoint = f"{self.endpoint}/api/{api_name}"
+        session = await self.get_client_session()
+        token = await self.get_token()
+        if token == None:
+            logger.warning("Error. Not possible to get session token")
+            return {"status": "failed"}
+        headers = {
+            "User-Agent": "netatmo-home",
+            "accept": "application/json",
+            "Authorization": "Bearer " + token
+        }
+        await asyncio.to_thread(self.netatmo.acquire_quota, method, api_name)
+        async with self.semaphore:
+            started = time.monotonic()
+            async with session.request(method, endpoint, params=self.get_query(parameters), headers=headers, json=body) as response:
+                content = await response.read()
+                status = response.status
+                observe_api_request(method, api_name, status, time.monotonic() - started, content)
+        if retry == True and self.is_token_rejected(status, content):
+            logger.info(f"Token rejected by {api_name}, obtaining a new one")
+            await asyncio.to_thread(self.netatmo.token_manager.invalidate, token)
+            return await self.api_request(method, api_name, parameters, retry=False, body=body)
+        self.netatmo.record_response(status, content)
+        if status == 200:
+            payload = json.loads(content)
+        else:
+            payload = {"status": "failed"}
+        return payload
+
+    async def get_default_home_id(self):
+        # Memoized and cached by the sync client
+        if self.netatmo.default_home_id != None:
+            return self.netatmo.default_home_id
+        home_id = await asyncio.to_thread(self.netatmo.get_default_home_id)
+        return home_id
+
+    async def get_home_id(self, home_id: str = None):
+        if home_id != None:
+            return home_id
+        elif self.netatmo.home_id != None:
+            return self.netatmo.home_id
+        return await self.get_default_home_id()
+
+    async def homesdata(self, home_id: str = None,  gateways_types: list = None):
+        parameters = {
+        }
+        if home_id != None:
+            parameters["home_id"] = home_id
+        elif self.netatmo.home_id != None:
+            parameters["home_id"] = self.netatmo.home_id
+        if gateways_types != None:
+            parameters["gateways_types"] = gateways_types
+        payload = await self.api_request("GET", "homesdata", parameters)
+        return payload
+
+    async def homestatus(self, home_id: str = None,  device_types: list = None):
+        parameters = {
+            "home_id": await self.get_home_id(home_id)
+        }
+        if device_types != None:
+            parameters["device_types"] = device_types
+        payload = await self.api_request("GET", "homestatus", parameters)
+        return payload
+
+    async def homestatus_many(self, home_ids: list, device_types: list = None):
+        """
+        Fetch homestatus for every home concurrently, at most `concurrency` requests in flight.
+        Returns a dict home_id -> payload. A failing home gets {"status": "failed"}.
+        """
+        await self.get_client_session()
+        tasks = [self.homestatus(home_id=home_id, device_types=device_types) for home_id in home_ids]
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
+        all_status = {}
+        for home_id, response in zip(home_ids, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Error obtaining homestatus home_id={home_id} exception={response}")
+                response = {"status": "failed"}
+            all_status[home_id] = response
+        return all_status
+
+    async def setthermmode(self, home_id: str = None,  mode="away"):
+        parameters = {
+            "home_id": await self.get_home_id(home_id),
+            "mode": mode
+        }
+        payload = await self.api_request("POST", "setthermmode", parameters)
+        current_status = await self.homestatus(home_id=parameters["home_id"])
+        return current_status
+
+    async def switchhomeschedule(self, schedule_id: str, home_id: str = None):
+        parameters = {
+            "home_id": await self.get_home_id(home_id),
+            "schedule_id": schedule_id
+        }
+        payload = await self.api_request("POST", "switchhomeschedule", parameters)
+        return payload
+
+    async def set_truetemperature(self, room_id, corrected_temperature, home_id=None):
+        home_id = await self.get_home_id(home_id)
+        home_data = await self.homestatus(home_id=home_id)
+        if home_data.get("status") != "ok":
+            logger.error(f"Not possible to read homestatus home_id={home_id} payload={home_data}")
+            return home_data
+        rooms = home_data["body"]["home"].get("rooms", [])
+        current_temperature = corrected_temperature
+        for room in rooms:
+            if room["id"] == room_id:
+                current_temperature = room["therm_measured_temperature"]
+                break
+        body = {"home_id": home_id, "room_id": room_id, "current_temperature": current_temperature, "corrected_temperature": corrected_temperature}
+        payload = await self.api_request("POST", "truetemperature", body=body)
+        logger.info(f"Done payload={payload}")
+        return payload
@@ -0,0 +1,178 @@
+#!/bin/python3
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+import os
+import logging
+from collections import deque
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+# Lower value is served first
+PRIORITY_COMMAND = 0
+PRIORITY_POLL = 10
+PRIORITY_BACKFILL = 20
+
+current_priority = contextvars.ContextVar("netatmo_request_priority", default=PRIORITY_POLL)
+
+class TokenBucket():
+
+    def __init__(self, capacity: int, window: float):
+        self.capacity = float(capacity)
+        self.rate = float(capacity) / float(window)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class RequestGovernor():
+    """
+    Shares the Netatmo api quota of one application (client_id) between every
+    thread and every user of the process. Each call takes a token from the
+    user buckets and the app buckets, waiting (never failing) when empty.
+    Waiters are served by priority, so commands overtake background polls.
+    https://dev.netatmo.com/guideline#rate-limits
+    """
+
+    # (requests, window seconds)
+    user_limits = [(50, 10), (500, 3600)]
+    app_limits = [(200, 10), (2000, 3600)]
+    accounting_windows = [10, 3600]
+
+    def __init__(self, user_limits: list = None, app_limits: list = None):
+        if user_limits != None:
+            self.user_limits = user_limits
+        if app_limits != None:
+            self.app_limits = app_limits
+        self.condition = threading.Condition()
+        self.app_buckets = [TokenBucket(capacity, window) for capacity, window in self.app_limits]
+        self.user_buckets = {}
+        self.waiters = []
+        self.counter = itertools.count()
+        # (user, api_name) -> timestamps of the calls inside the largest accounting window
+        self.calls = {}
+
+    def get_user_buckets(self, user: str):
+        if user not in self.user_buckets:
+            self.user_buckets[user] = [TokenBucket(capacity, window) for capacity, window in self.user_limits]
+        return self.user_buckets[user]
+
+    def get_wait_time(self, buckets: list, now: float):
+        return max([bucket.wait_time(now) for bucket in buckets])
+
+    def can_proceed(self, ticket: tuple, now: float):
+        # A waiter goes when its buckets allow it, unless a waiter ahead of it is the same user
+        # or is only held back by the shared app buckets (then the app tokens are reserved for it)
+        for waiter in sorted(self.waiters):
+            if waiter == ticket:
+                break
+            if waiter[2] == ticket[2]:
+                return False, None
+            if self.get_wait_time(self.get_user_buckets(waiter[2]), now) == 0:
+                return False, None
+        buckets = self.get_user_buckets(ticket[2]) + self.app_buckets
+        wait = self.get_wait_time(buckets, now)
+        return wait == 0, wait
+
+    def acquire(self, user: str, api_name: str, priority: int = None, timeout: float = None):
+        if priority == None:
+            priority = current_priority.get()
+        started = time.monotonic()
+        with self.condition:
+            ticket = (priority, next(self.counter), user)
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    allowed, wait = self.can_proceed(ticket, now)
+                    if allowed == True:
+                        for bucket in self.get_user_buckets(user) + self.app_buckets:
+                            bucket.consume()
+                        self.record(user, api_name, time.time())
+                        break
+                    if timeout != None and now - started >= timeout:
+                        raise TimeoutError(f"Netatmo quota wait exceeded {timeout} seconds for {api_name}")
+                    if wait == None:
+                        wait = 1
+                    self.condition.wait(timeout=min(max(wait, 0.01), 1))
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+        waited = time.monotonic() - started
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f} seconds for netatmo quota api={api_name} priority={priority}")
+        return waited
+
+    def record(self, user: str, api_name: str, timestamp: float):
+        key = (user, api_name)
+        if key not in self.calls:
+            self.calls[key] = deque()
+        calls = self.calls[key]
+        calls.append(timestamp)
+        oldest = timestamp - max(self.accounting_windows)
+        while calls and calls[0] < oldest:
+            calls.popleft()
+
+    def get_stats(self):
+        now = time.time()
+        stats = {
+            "waiting": 0,
+            "app_tokens": [],
+            "users": {}
+        }
+        with self.condition:
+            stats["waiting"] = len(self.waiters)
+            for bucket in self.app_buckets:
+                bucket.refill(time.monotonic())
+            stats["app_tokens"] = [int(bucket.tokens) for bucket in self.app_buckets]
+            for (user, api_name), calls in self.calls.items():
+                user_stats = stats["users"].setdefault(user, {"tokens": [int(bucket.tokens) for bucket in self.get_user_buckets(user)], "endpoints": {}})
+                endpoint_stats = {}
+                for window in self.accounting_windows:
+                    endpoint_stats[f"last_{window}s"] = len([timestamp for timestamp in calls if timestamp >= now - window])
+                user_stats["endpoints"][api_name] = endpoint_stats
+        return stats
+
+    @contextlib.contextmanager
+    def priority(self, priority: int):
+        # Every netatmo call done inside the block (same thread or asyncio task) uses this priority
+        token = current_priority.set(priority)
+        try:
+            yield
+        finally:
+            current_priority.reset(token)
+
+governors = {}
+governors_lock = threading.Lock()
+
+def get_governor(client_id: str):
+    # One governor per Netatmo application, shared by every Netatmo_API instance of the process
+    with governors_lock:
+        if client_id not in governors:
+            governors[client_id] = RequestGovernor()
+        return governors[client_id]
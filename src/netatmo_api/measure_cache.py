@@ -0,0 +1,61 @@
+#!/bin/python3
+import hashlib
+import json
+import os
+import threading
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+class MeasureCache():
+    """
+    On disk cache of closed measure chunks. A chunk that ended in the past never
+    changes, so it is kept forever, one json file per chunk. As every chunk is
+    written as soon as it is fetched, the cache is also the checkpoint of an
+    interrupted backfill: the next run only fetches the missing chunks.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, api_name: str, key: tuple, chunk_begin: int):
+        # key holds the request parameters (home, room or module, scale, types)
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, api_name, digest, f"{chunk_begin}.json")
+
+    def get(self, api_name: str, key: tuple, chunk_begin: int):
+        path = self.get_path(api_name, key, chunk_begin)
+        try:
+            with open(path) as my_file:
+                chunk = json.load(my_file)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return chunk
+
+    def put(self, api_name: str, key: tuple, chunk_begin: int, chunk: dict):
+        path = self.get_path(api_name, key, chunk_begin)
+        chunk_dir = os.path.dirname(path)
+        if not os.path.exists(chunk_dir):
+            os.makedirs(chunk_dir, exist_ok=True)
+        # Write then rename so an interruption never leaves a truncated chunk behind
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as my_file:
+            json.dump(chunk, my_file)
+        os.replace(temporary_path, path)
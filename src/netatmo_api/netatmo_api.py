@@ -1,13 +1,18 @@
 #!/bin/python3
-from urllib import response
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import sys
 import os
-import configparser
 import logging
-from lxml import html
-import pickle
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .token_manager import TokenManager
+from .governor import get_governor, PRIORITY_COMMAND, PRIORITY_BACKFILL
+from .measure_cache import MeasureCache
+from .singleflight import login_flights
+from .token_store import get_token_store, get_default_token_file, default_token_dir
+from metrics import observe_api_request, API_QUOTA_WAIT_SECONDS, API_RATE_LIMITED
 
 logging.basicConfig(level=logging.INFO)
 
@@ -24,17 +29,37 @@ logger.propagate = False
 class Netatmo_API():
 
     endpoint = "https://api.netatmo.com"
-    cookies_file = os.path.realpath(os.path.dirname(__file__)) + "/tmp/cookies.tmp"
+    # Web login endpoints, configurable to test against a local server
+    auth_endpoint = "https://auth.netatmo.com"
+    app_endpoint = "https://app.netatmo.net"
+    token_dir = default_token_dir
     home_id = None
     token = None
     access_token = None
     session = None
     redirect_uri = None
+    pool_size = 10
+    timeout = 15
+    topology_ttl = 3600
+    default_home_id = None
+    last_error_status = None
+    rate_limited = False
+    # Netatmo measure scales in seconds and max measures per request
+    measure_scales = {"30min": 1800, "1hour": 3600, "3hours": 10800, "1day": 86400, "1week": 604800, "1month": 2678400}
+    measure_limit = 1024
+    measure_concurrency = 4
+    # Closed measure chunks and backfill checkpoints, an empty measure_cache_dir disables the cache
+    measure_cache_dir = os.path.realpath(os.path.dirname(__file__)) + "/tmp/measures"
+    measure_cache = None
     scopes = "read_station read_thermostat write_thermostat read_camera write_camera access_camera read_presence access_presence read_smokedetector read_homecoach"
 
-    def __init__(self, client_id, client_secret, username, password, home_id: str = None, endpoint: str ="https://api.netatmo.com", scopes: str =None, access_token: str = None, redirect_uri: str =None, refresh_token: str = None):
+    def __init__(self, client_id, client_secret, username, password, home_id: str = None, endpoint: str ="https://api.netatmo.com", scopes: str =None, access_token: str = None, redirect_uri: str =None, refresh_token: str = None, pool_size: int = None, timeout: float = None, token_refresh_margin: int = None, topology_ttl: int = None, measure_cache_dir: str = None, measure_concurrency: int = None, auth_endpoint: str = None, app_endpoint: str = None, token_file: str = None):
         logger.info("Init")
         self.endpoint = endpoint
+        if auth_endpoint != None:
+            self.auth_endpoint = auth_endpoint
+        if app_endpoint != None:
+            self.app_endpoint = app_endpoint
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
@@ -47,21 +72,135 @@ class Netatmo_API():
             self.scopes = scopes
         if access_token != None:
             self.access_token = access_token
+        if pool_size != None:
+            self.pool_size = int(pool_size)
+        if timeout != None:
+            self.timeout = float(timeout)
+        if topology_ttl != None:
+            self.topology_ttl = int(topology_ttl)
+        if measure_cache_dir != None:
+            self.measure_cache_dir = measure_cache_dir
+        if self.measure_cache_dir != "":
+            self.measure_cache = MeasureCache(self.measure_cache_dir)
+        if measure_concurrency != None:
+            self.measure_concurrency = int(measure_concurrency)
+        if token_file == None:
+            token_file = get_default_token_file(username, self.token_dir)
+        self.token_store = get_token_store(token_file)
+        self.token_manager = TokenManager(self, refresh_token=refresh_token, refresh_margin=token_refresh_margin)
+        self.governor = get_governor(client_id)
+        # homesdata responses by request parameters -> (timestamp, payload)
+        self.topology_cache = {}
+        self.topology_lock = threading.Lock()
+
+    def get_http_session(self):
+        # One keep-alive pool per account, shared by the auth flow and the api calls
+        if self.session == None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.session = session
+        return self.session
+
+    def api_request(self, method: str, api_name: str, parameters: dict = None, retry: bool = True):
+        endpoint = f"{self.endpoint}/api/{api_name}"
+        token = self.get_token()
+        if token == None:
+            logger.warning("Error. Not possible to get session token")
+            return {"status": "failed"}
+        headers = {
+            "User-Agent": "netatmo-home",
+            "accept": "application/json",
+            "Authorization": "Bearer " + token
+        }
+        session = self.get_http_session()
+        self.acquire_quota(method, api_name)
+        started = time.monotonic()
+        response = session.request(method, endpoint, params=parameters, headers=headers, timeout=self.timeout)
+        observe_api_request(method, api_name, response.status_code, time.monotonic() - started, response.content)
+        if retry == True and self.is_token_rejected(response):
+            logger.info(f"Token rejected by {api_name}, obtaining a new one")
+            self.token_manager.invalidate(token)
+            return self.api_request(method, api_name, parameters, retry=False)
+        self.record_response(response.status_code, response.content)
+        if response.status_code == 200:
+            payload = json.loads(response.content)
+        else:
+            payload = {"status": "failed"}
+        return payload
+
+    def acquire_quota(self, method: str, api_name: str):
+        # Writes are always commands, reads take the priority of the calling context
+        if method == "POST":
+            priority = PRIORITY_COMMAND
+        else:
+            priority = None
+        waited = self.governor.acquire(self.username, api_name, priority=priority)
+        API_QUOTA_WAIT_SECONDS.labels(api_name).observe(waited)
+        return waited
+
+    def record_response(self, status_code: int, content: bytes = None):
+        # Remembers api failures until reset_errors so the poller can back off
+        if status_code == 200:
+            return
+        error_code = None
+        try:
+            error_code = json.loads(content)["error"]["code"]
+        except Exception:
+            pass
+        self.last_error_status = status_code
+        # Netatmo answers 429, or 403 with error code 26 (user usage reached)
+        if status_code == 429 or error_code == 26:
+            self.rate_limited = True
+            API_RATE_LIMITED.inc()
+        logger.warning(f"Netatmo api error status={status_code} error_code={error_code}")
+
+    def reset_errors(self):
+        self.last_error_status = None
+        self.rate_limited = False
 
     def get_default_home_id(self):
-        payload = self.homesdata()
-        home_id = payload["body"]["homes"][0]["id"]
-        return home_id
+        if self.default_home_id == None:
+            payload = self.homesdata()
+            self.default_home_id = payload["body"]["homes"][0]["id"]
+        return self.default_home_id
+
+    def invalidate_topology(self):
+        logger.info("Invalidating homesdata cache")
+        with self.topology_lock:
+            self.topology_cache = {}
+            self.default_home_id = None
 
     def get_token(self):
-        login_headers = self.get_session_headers()
         # https://dev.netatmo.com/apidocumentation/oauth
-        token = login_headers["Authorization"].split(" ")[1]
+        token = self.token_manager.get_token()
         self.token = token
         return token
 
-    def homesdata(self, home_id: str = None,  gateways_types: list = None):
-        endpoint = f"{self.endpoint}/api/homesdata"
+    def is_token_rejected(self, response):
+        # Netatmo error codes 2 (invalid token) and 3 (expired token)
+        if response.status_code == 401:
+            return True
+        if response.status_code == 403:
+            try:
+                error_code = response.json()["error"]["code"]
+            except Exception:
+                return False
+            return error_code in [2, 3]
+        return False
+
+    def get_auth_headers(self):
+        token = self.get_token()
+        headers = {
+            "User-Agent": "netatmo-home",
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {token}"
+        }
+        return headers
+
+    def homesdata(self, home_id: str = None,  gateways_types: list = None, use_cache: bool = True):
         parameters = {
         }
         if home_id != None:
@@ -70,25 +209,19 @@ class Netatmo_API():
             parameters["home_id"] = self.home_id
         if gateways_types != None:
             parameters["gateways_types"] = gateways_types
-        if self.token == None:
-            self.get_token()
-        if self.token == None:
-            logger.warning("Error. Not possible to get session token")
-            return None
-        headers = {
-            "User-Agent": "netatmo-home",
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.token
-        }
-        response = requests.get(endpoint, params=parameters, headers=headers)
-        if response.status_code == 200:
-            payload = json.loads(response.content)
-        else:
-            payload = {"status": "failed"}
+        # Homes, rooms, modules and schedules barely change, serve them from cache during topology_ttl
+        cache_key = (parameters.get("home_id"), tuple(gateways_types or []))
+        with self.topology_lock:
+            cached = self.topology_cache.get(cache_key)
+        if use_cache == True and cached != None and time.time() - cached[0] < self.topology_ttl:
+            return cached[1]
+        payload = self.api_request("GET", "homesdata", parameters)
+        if payload != None and "body" in payload:
+            with self.topology_lock:
+                self.topology_cache[cache_key] = (time.time(), payload)
         return payload
 
     def homestatus(self, home_id: str = None,  device_types: list = None):
-        endpoint = f"{self.endpoint}/api/homestatus"
         parameters = {
         }
         if home_id != None:
@@ -99,37 +232,107 @@ class Netatmo_API():
             parameters["home_id"] = self.get_default_home_id()
         if device_types != None:
             parameters["device_types"] = device_types
-        if self.token == None:
-            self.get_token()
-        headers = {
-            "User-Agent": "netatmo-home",
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.token
-        }
-        response = requests.get(endpoint, params=parameters, headers=headers)
-        if response.status_code == 200:
-            payload = json.loads(response.content)
-        else:
-            payload = {"status": "failed"}
+        payload = self.api_request("GET", "homestatus", parameters)
         return payload
 
-    # # TODO: Pending
-    # def getroommeasure(self):
-    #     endpoint = f"{self.endpoint}/api/getroommeasure"
-    #     parameters = {
-    #     }
-    #     if self.token == None:
-    #         self.get_token()
-    #     headers = {
-    #         "accept": "application/json",
-    #         "Authorization": "Bearer " + self.token
-    #     }
-    #     response = requests.get(endpoint, params=parameters, headers=headers)
-    #     if response.status_code == 200:
-    #         payload = json.loads(response.content)
-    #     else:
-    #         payload = {"status": "failed"}
-    #     return payload
+    def getroommeasure(self, room_id: str, home_id: str = None, scale: str = "30min", types: list = None, date_begin: int = None, date_end: int = None):
+        """
+        Room measures between date_begin and date_end (unix seconds, default the last 7 days)
+        as {"status", "body": {timestamp: [value per type]}, "failed_chunks"}.
+        """
+        if types == None:
+            types = ["temperature"]
+        if home_id == None:
+            if self.home_id != None:
+                home_id = self.home_id
+            else:
+                home_id = self.get_default_home_id()
+        if date_end == None:
+            date_end = time.time()
+        if date_begin == None:
+            date_begin = date_end - 7 * 86400
+        parameters = {
+            "home_id": home_id,
+            "room_id": room_id,
+            "scale": scale,
+            "type": ",".join(types),
+            "optimize": "false",
+            "real_time": "true"
+        }
+        return self.get_measure_range("getroommeasure", parameters, scale, int(date_begin), int(date_end))
+
+    def get_measure_chunks(self, scale: str, date_begin: int, date_end: int):
+        # Chunks of measure_limit measures aligned on the epoch, so the same chunks come back on every query
+        span = self.measure_scales[scale] * self.measure_limit
+        chunk_begin = date_begin - date_begin % span
+        chunks = []
+        while chunk_begin <= date_end:
+            chunks.append((chunk_begin, chunk_begin + span - 1))
+            chunk_begin += span
+        return chunks
+
+    def fetch_measure_chunk(self, api_name: str, parameters: dict, chunk_begin: int, chunk_end: int):
+        chunk_parameters = dict(parameters)
+        chunk_parameters["date_begin"] = chunk_begin
+        chunk_parameters["date_end"] = chunk_end
+        chunk_parameters["limit"] = self.measure_limit
+        response = self.api_request("GET", api_name, chunk_parameters)
+        if response.get("status") != "ok" or "body" not in response:
+            logger.error(f"Not possible to fetch {api_name} from {chunk_begin} to {chunk_end} response={response}")
+            return None
+        # Netatmo answers an empty list instead of an empty dict when there is no measure
+        if type(response["body"]) != dict:
+            return {}
+        return response["body"]
+
+    def get_measure_range(self, api_name: str, parameters: dict, scale: str, date_begin: int, date_end: int):
+        """
+        Splits the range in chunks fetched concurrently (measure_concurrency threads) at backfill
+        priority, so polls and commands keep their quota. Chunks whose last bucket is closed are
+        read from and written to the measure cache; only the open tail always hits the network.
+        """
+        key = [api_name] + sorted(parameters.items())
+        closed_before = int(time.time()) - self.measure_scales[scale]
+        chunks = self.get_measure_chunks(scale, date_begin, date_end)
+        results = {}
+        missing = []
+        for chunk_begin, chunk_end in chunks:
+            if self.measure_cache != None and chunk_end < closed_before:
+                cached = self.measure_cache.get(api_name, key, chunk_begin)
+                if cached != None:
+                    results[chunk_begin] = cached
+                    continue
+            missing.append((chunk_begin, chunk_end))
+
+        def fetch(chunk: tuple):
+            chunk_begin, chunk_end = chunk
+            with self.governor.priority(PRIORITY_BACKFILL):
+                body = self.fetch_measure_chunk(api_name, parameters, chunk_begin, chunk_end)
+            # Stored right away: an interrupted backfill restarts from the missing chunks only
+            if body != None and self.measure_cache != None and chunk_end < closed_before:
+                self.measure_cache.put(api_name, key, chunk_begin, body)
+            return body
+
+        failed_chunks = 0
+        if len(missing) > 0:
+            logger.info(f"Fetching {len(missing)} of {len(chunks)} {api_name} chunks")
+            with ThreadPoolExecutor(max_workers=min(self.measure_concurrency, len(missing))) as executor:
+                for (chunk_begin, chunk_end), body in zip(missing, executor.map(fetch, missing)):
+                    if body == None:
+                        failed_chunks += 1
+                    else:
+                        results[chunk_begin] = body
+        measures = {}
+        for chunk_begin in sorted(results):
+            for timestamp, values in sorted(results[chunk_begin].items(), key=lambda measure: int(measure[0])):
+                if date_begin <= int(timestamp) <= date_end:
+                    measures[timestamp] = values
+        payload = {
+            "status": "ok" if failed_chunks == 0 else "partial",
+            "body": measures,
+            "failed_chunks": failed_chunks
+        }
+        return payload
 
     # # TODO: Pending
     # def setroomthermpoint(self, mode="away"):
@@ -151,8 +354,7 @@ class Netatmo_API():
     #         payload = {"status": "failed"}
     #     return payload
 
-    def setthermmode(self, home_id: str = None,  mode="away"):
-        endpoint = f"{self.endpoint}/api/setthermmode"
+    def setthermmode(self, home_id: str = None,  mode="away", refresh: bool = True):
         parameters = {}
         if home_id != None:
             parameters["home_id"] = home_id
@@ -161,21 +363,22 @@ class Netatmo_API():
         else:
             parameters["home_id"] = self.get_default_home_id()
         parameters["mode"] = mode
-        if self.token == None:
-            self.get_token()
-        headers = {
-            "User-Agent": "netatmo-home",
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.token
-        }
-        response = requests.post(endpoint, params=parameters, headers=headers)
-        if response.status_code == 200:
-            payload = json.loads(response.content)
-        else:
-            payload = {"status": "failed"}
+        payload = self.api_request("POST", "setthermmode", parameters)
+        if payload.get("status") == "ok":
+            self.update_cached_home(parameters["home_id"], therm_mode=mode)
+        if refresh == False:
+            return payload
         current_status = self.homestatus(home_id=parameters["home_id"])
         return current_status
 
+    def update_cached_home(self, home_id: str, **fields):
+        # therm_mode lives in homesdata, keep the topology cache coherent after a write
+        with self.topology_lock:
+            for cached_time, payload in self.topology_cache.values():
+                for home in payload["body"].get("homes", []):
+                    if home["id"] == home_id:
+                        home.update(fields)
+
     def get_xsrf_token(self):
         if self.token == None:
             self.get_token()
@@ -184,7 +387,7 @@ class Netatmo_API():
             "accept": "application/json",
             "Authorization": "Bearer " + self.access_token
         }
-        response = requests.get("https://auth.netatmo.com/de-DE/access/login", headers=headers)
+        response = self.get_http_session().get(f"{self.auth_endpoint}/de-DE/access/login", headers=headers, timeout=self.timeout)
         all_cookies = response.cookies.get_dict()
         if "XSRF-TOKEN" in all_cookies:
             XSRF_TOKEN = all_cookies["XSRF-TOKEN"]
@@ -193,98 +396,55 @@ class Netatmo_API():
         return XSRF_TOKEN
 
     def get_session_headers(self, username=None, password=None):
+        # Single flight: concurrent callers for the same account wait for the login in progress
         if username == None:
             username = self.username
         if password == None:
             password = self.password
+        headers, cookies = login_flights.do((self.auth_endpoint, username), lambda: (self.login(username, password), self.get_http_session().cookies))
+        # Waiters of another instance of the account take the session cookies of the login
+        session = self.get_http_session()
+        if cookies is not session.cookies:
+            session.cookies.update(cookies)
+        return headers
+
+    def login(self, username, password):
+        # Web login, the resulting token is persisted by TokenManager in the token store
         headers = {
             "User-Agent": "netatmo-home"
             }
-        successful = False   
-        if self.session == None:
-            session = requests.Session()
-            self.session = session
+        session = self.get_http_session()
+        logger.info("Required to re-authenticate to obtain new credentials")
+        req = session.get(f"{self.auth_endpoint}/en-us/access/login", headers=headers, timeout=self.timeout)
+        if req.status_code != 200:
+            logger.error(f"Unable to contact {self.auth_endpoint}/en-us/access/login")
+            logger.critical("Error: {0}".format(req.status_code))
+            raise Exception("Error: {0}".format(req.status_code))
         else:
-            session = self.session
-        if os.path.exists(self.cookies_file):
-            with open(self.cookies_file, "rb") as my_file:
-                my_session_cookies = pickle.load(my_file)
-            self.session.cookies = my_session_cookies
-            """
-            check if we got a valid session cookie
-            """
-            req1 = self.session.get("https://auth.netatmo.com/access/csrf")
-            if req1.status_code == 200:
-                token_data = json.loads(req1.text)
-                token = token_data["token"]
-                try:
-                    headers = self.get_access_token_from_cookie(self.session.cookies)
-                except Exception as e:
-                    logger.warning("Error " + str(e))
-                    logger.info(f"Removing {self.cookies_file}")
-                    os.remove(self.cookies_file)
-                if os.path.exists(self.cookies_file):
-                    req2 = self.session.get("https://app.netatmo.net/api/homesdata", headers=headers)
-                    if req2.status_code == 200:
-                        logger.info("Obtained credentials from cache")
-                        successful = True
-                    else:
-                        logger.info(f"Removing {self.cookies_file}")
-                        os.remove(self.cookies_file)
-            else:
-                logger.info(f"Removing {self.cookies_file}")
-                os.remove(self.cookies_file)
-        if successful == False:
-            logger.info("Required to re-authenticate to obtain new credentials")
-            req = self.session.get("https://auth.netatmo.com/en-us/access/login", headers=headers)
-            if req.status_code != 200:
-                logger.error("Unable to contact https://auth.netatmo.com/en-us/access/login")
-                logger.critical("Error: {0}".format(req.status_code))
-                raise Exception("Error: {0}".format(req.status_code))
-                #sys.exit(-1)
-            else:
-                logger.info("Successfully got session cookie from https://auth.netatmo.com/en-us/access/login")
-            self.session.cookies.set("netatmocomlast_app_used", "app_thermostat", domain=".netatmo.com")
-            req2 = self.session.get("https://auth.netatmo.com/access/csrf")
-            if req2.status_code == 200:
-                token_data = json.loads(req2.text)
-                token = token_data["token"]
-            else:
-                logger.warning("Problem obtaining session token")
-                raise Exception("Problem obtaining session token")
-                # sys.exit(-1)
-            payload = {'email': username,
-                    'password': password,
-                    "stay_logged": "on",
-                    #"website": None,
-                    '_token': token } 
-
-            req3 = self.session.post("https://auth.netatmo.com/access/postlogin", data=payload, headers=headers, allow_redirects=False)
-            cookies = self.session.cookies.get_dict()
-            param = { 'next_url' : 'https://my.netatmo.com' }
-            req4 = self.session.get("https://auth.netatmo.com/access/keychain", params=param, headers=headers, allow_redirects=False)
-            cookies = self.session.cookies.get_dict()
-            headers = self.get_access_token_from_cookie(self.session.cookies)
-            req5 = self.session.get("https://app.netatmo.net/api/homesdata", headers=headers)
-            if req5.status_code == 200:
-                logger.info("Successfully obtained credentials")
-            else:
-                logger.error("Error obtaining credentials")
-                raise Exception("Error obtaining credentials")
-            my_session_cookies = self.session.cookies
-            temp_dir = os.path.realpath(os.path.dirname(self.cookies_file)) 
-            if not os.path.exists(temp_dir):
-                logger.info(f"Creating {temp_dir}")
-                os.makedirs(temp_dir)
-            with open(self.cookies_file, "wb") as my_file:
-                pickle.dump(my_session_cookies, my_file)
-                logger.info(f"Persisted session cookies at {self.cookies_file}")
-                successful = True
-        if successful == False:
-            logger.critical("No _token value found in response from https://auth.netatmo.com/en-us/access/login")
-            raise Exception("No _token value found in response from https://auth.netatmo.com/en-us/access/login")
+            logger.info(f"Successfully got session cookie from {self.auth_endpoint}/en-us/access/login")
+        session.cookies.set("netatmocomlast_app_used", "app_thermostat", domain=".netatmo.com")
+        req2 = session.get(f"{self.auth_endpoint}/access/csrf", timeout=self.timeout)
+        if req2.status_code == 200:
+            token_data = json.loads(req2.text)
+            token = token_data["token"]
+        else:
+            logger.warning("Problem obtaining session token")
+            raise Exception("Problem obtaining session token")
+        payload = {'email': username,
+                'password': password,
+                "stay_logged": "on",
+                '_token': token } 
+
+        req3 = session.post(f"{self.auth_endpoint}/access/postlogin", data=payload, headers=headers, allow_redirects=False, timeout=self.timeout)
+        param = { 'next_url' : 'https://my.netatmo.com' }
+        req4 = session.get(f"{self.auth_endpoint}/access/keychain", params=param, headers=headers, allow_redirects=False, timeout=self.timeout)
+        headers = self.get_access_token_from_cookie(session.cookies)
+        req5 = session.get(f"{self.app_endpoint}/api/homesdata", headers=headers, timeout=self.timeout)
+        if req5.status_code == 200:
+            logger.info("Successfully obtained credentials")
         else:
-            logger.debug("Found _token value {0} in response from https://auth.netatmo.com/en-us/access/login".format(token))
+            logger.error("Error obtaining credentials")
+            raise Exception("Error obtaining credentials")
         return headers
         
     def get_access_token_from_cookie(self, cookies):
@@ -302,14 +462,20 @@ class Netatmo_API():
             "Authorization": authentication_value
         }
         return headers
+
+    def get_access_token_expires_in(self, cookies):
+        cookie_name = "netatmocomaccess_token"
+        for cookie in cookies:
+            if cookie.name == cookie_name and cookie.expires != None:
+                return max(cookie.expires - time.time(), 0)
+        return None
             
     def login_page(self, username=None, password=None):
         if username == None:
             username = self.username
         if password == None:
             password = self.password
-        if self.session == None:
-            self.session = requests.Session()
+        self.get_http_session()
 
         headers = {
             "User-Agent": "netatmo-home"
@@ -326,16 +492,15 @@ class Netatmo_API():
         if home_id == None:
             home_id = self.get_default_home_id()
 
-        if self.session == None:
-            session = requests.Session()
-            self.session = session
-        else:
-            session = self.session
+        session = self.get_http_session()
 
-        headers = self.login_page()
+        headers = self.get_auth_headers()
 
         payload={"home_id": home_id}
-        req3 = session.get(f"{self.endpoint}/api/homestatus", headers=headers, params=payload)
+        self.acquire_quota("GET", "homestatus")
+        started = time.monotonic()
+        req3 = session.get(f"{self.endpoint}/api/homestatus", headers=headers, params=payload, timeout=self.timeout)
+        observe_api_request("GET", "homestatus", req3.status_code, time.monotonic() - started, req3.content)
 
         home_data = json.loads(req3.text)
         home = home_data["body"]["home"]
@@ -348,28 +513,50 @@ class Netatmo_API():
         # netatmocomaccess_token
         payload={"home_id": home_id,"room_id": room_id,"current_temperature":current_temperature,"corrected_temperature":corrected_temperature}
         #req4 = session.post("https://app.netatmo.net/api/truetemperature",  json=payload, headers=headers)
-        req4 = session.post(f"{self.endpoint}/api/truetemperature",  json=payload, headers=headers)
+        self.acquire_quota("POST", "truetemperature")
+        started = time.monotonic()
+        req4 = session.post(f"{self.endpoint}/api/truetemperature",  json=payload, headers=headers, timeout=self.timeout)
+        observe_api_request("POST", "truetemperature", req4.status_code, time.monotonic() - started, req4.content)
         payload_response = json.loads(req4.text)
         logger.info(f"Done status={req4.status_code} payload={payload_response}")
         return payload_response
 
-    # # TODO: Pending
-    # def getmeasure(self):
-    #     endpoint = f"{self.endpoint}/api/getmmeasure"
-    #     parameters = {
-    #     }
-    #     if self.token == None:
-    #         self.get_token()
-    #     headers = {
-    #         "accept": "application/json",
-    #         "Authorization": "Bearer " + self.token
-    #     }
-    #     response = requests.get(endpoint, params=parameters, headers=headers)
-    #     if response.status_code == 200:
-    #         payload = json.loads(response.content)
-    #     else:
-    #         payload = {"status": "failed"}
-    #     return payload
+    def getmeasure(self, device_id: str, module_id: str = None, scale: str = "max", types: list = None, date_begin: int = None, date_end: int = None):
+        """
+        Generator of (timestamp, value per type) rows of a weather station or homecoach device,
+        oldest first. Pages of measure_limit measures are requested one at a time, each one
+        starting after the last timestamp of the previous page, so memory use stays flat.
+        """
+        if types == None:
+            types = ["Temperature", "Humidity"]
+        if date_end == None:
+            date_end = time.time()
+        if date_begin == None:
+            date_begin = date_end - 86400
+        parameters = {
+            "device_id": device_id,
+            "scale": scale,
+            "type": ",".join(types),
+            "optimize": "false",
+            "real_time": "true"
+        }
+        if module_id != None:
+            parameters["module_id"] = module_id
+        date_begin = int(date_begin)
+        date_end = int(date_end)
+        while date_begin <= date_end:
+            with self.governor.priority(PRIORITY_BACKFILL):
+                page = self.fetch_measure_chunk("getmeasure", parameters, date_begin, date_end)
+            if page == None:
+                raise Exception(f"Not possible to fetch getmeasure device_id={device_id} module_id={module_id} from {date_begin}")
+            timestamps = sorted([int(timestamp) for timestamp in page.keys()])
+            if len(timestamps) == 0:
+                break
+            for timestamp in timestamps:
+                if timestamp > date_end:
+                    return
+                yield (timestamp, *page[str(timestamp)])
+            date_begin = timestamps[-1] + 1
 
     # # TODO: Pending
     # def synchomeschedule(self, mode="away"):
@@ -392,7 +579,6 @@ class Netatmo_API():
     #     return payload
 
     def switchhomeschedule(self, schedule_id: str, home_id: str = None):
-        endpoint = f"{self.endpoint}/api/switchhomeschedule"
         parameters = {}
         if home_id != None:
             parameters["home_id"] = home_id
@@ -401,16 +587,5 @@ class Netatmo_API():
         else:
             parameters["home_id"] = self.get_default_home_id()
         parameters["schedule_id"] = schedule_id
-        if self.token == None:
-            self.get_token()
-        headers = {
-            "User-Agent": "netatmo-home",
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.token
-        }
-        response = requests.post(endpoint, params=parameters, headers=headers)
-        if response.status_code == 200:
-            payload = json.loads(response.content)
-        else:
-            payload = {"status": "failed"}
+        payload = self.api_request("POST", "switchhomeschedule", parameters)
         return payload
@@ -0,0 +1,55 @@
+#!/bin/python3
+import threading
+
+
+class Flight():
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight():
+    """
+    Runs at most one call per key at a time. Callers arriving while a call for
+    the same key is in flight wait for it and get its result (or its exception)
+    instead of starting their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight != None:
+                flight.waiters += 1
+                self.shared += 1
+                leader = False
+            else:
+                flight = Flight()
+                self.flights[key] = flight
+                self.calls += 1
+                leader = True
+        if leader == False:
+            flight.done.wait()
+            if flight.error != None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = function(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+# Web logins of every Netatmo_API instance of the process, keyed by (auth endpoint, username)
+login_flights = SingleFlight()
@@ -0,0 +1,147 @@
+#!/bin/python3
+import datetime
+import threading
+import time
+import os
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+class TokenManager():
+    """
+    Keeps the bearer token of a Netatmo_API in memory together with its expiry.
+    While the token is fresh no validation round trip is done. Once inside the
+    refresh margin it is renewed, first with the oauth refresh_token (if any) and
+    falling back to the web login of Netatmo_API.get_session_headers: by a job of
+    the daemon scheduler (set_scheduler) before it expires, or by the next get_token.
+    No thread is kept per account.
+    Renewed tokens are persisted in the token store of the account, so that other
+    processes and restarts reuse them instead of logging in again.
+    """
+
+    token_url = "https://api.netatmo.com/oauth2/token"
+    # https://dev.netatmo.com/apidocumentation/oauth access tokens last 3 hours
+    default_expires_in = 10800
+    refresh_margin = 300
+    retry_delay = 60
+    access_token = None
+    refresh_token = None
+    expires_at = 0
+    scheduler = None
+
+    def __init__(self, netatmo, refresh_token: str = None, refresh_margin: int = None):
+        self.netatmo = netatmo
+        self.lock = threading.RLock()
+        self.job_id = f"token_refresh_{id(self)}"
+        if refresh_token != None:
+            self.refresh_token = refresh_token
+        if refresh_margin != None:
+            self.refresh_margin = int(refresh_margin)
+
+    def is_fresh(self):
+        return self.access_token != None and time.time() < self.expires_at - self.refresh_margin
+
+    def get_token(self):
+        with self.lock:
+            if not self.is_fresh():
+                self.refresh()
+            return self.access_token
+
+    def set_token(self, access_token: str, expires_in: float = None, refresh_token: str = None):
+        if expires_in == None:
+            expires_in = self.default_expires_in
+        with self.lock:
+            self.access_token = access_token
+            self.expires_at = time.time() + float(expires_in)
+            if refresh_token != None:
+                self.refresh_token = refresh_token
+        logger.info(f"Token valid for {int(float(expires_in))} seconds")
+        self.schedule_refresh()
+
+    def invalidate(self, access_token: str = None):
+        # With access_token, only when it is still the current one: callers that got the same
+        # rejection after another thread already renewed it must not force another login
+        with self.lock:
+            if access_token != None and access_token != self.access_token:
+                return
+            if access_token == None:
+                access_token = self.access_token
+            self.access_token = None
+            self.expires_at = 0
+            # Still holding the lock, a concurrent refresh must not pick the rejected token from the store
+            if access_token != None:
+                self.netatmo.token_store.clear(access_token)
+
+    def refresh(self):
+        token_store = self.netatmo.token_store
+        with token_store.locked():
+            credentials = token_store.load()
+            if credentials != None and credentials.get("refresh_token") != None:
+                self.refresh_token = credentials["refresh_token"]
+            credentials = token_store.get_fresh(self.refresh_margin)
+            if credentials != None and credentials["access_token"] != self.access_token:
+                logger.info(f"Obtained token from {token_store.token_file}")
+                self.set_token(credentials["access_token"], credentials["expires_at"] - time.time())
+                return self.access_token
+            if self.refresh_token != None:
+                try:
+                    self.refresh_oauth_token()
+                    return self.access_token
+                except Exception as e:
+                    logger.warning(f"Not possible to refresh oauth token, falling back to login. Exception {e}")
+            headers = self.netatmo.get_session_headers()
+            access_token = headers["Authorization"].split(" ")[1]
+            expires_in = self.netatmo.get_access_token_expires_in(self.netatmo.session.cookies)
+            self.set_token(access_token, expires_in)
+            token_store.save(access_token, self.expires_at)
+        return self.access_token
+
+    def refresh_oauth_token(self):
+        session = self.netatmo.get_http_session()
+        payload = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token,
+            "client_id": self.netatmo.client_id,
+            "client_secret": self.netatmo.client_secret
+        }
+        response = session.post(self.token_url, data=payload, timeout=self.netatmo.timeout)
+        if response.status_code != 200:
+            raise Exception(f"Error refreshing token status={response.status_code}")
+        token_data = response.json()
+        self.set_token(token_data["access_token"], token_data.get("expires_in"), token_data.get("refresh_token"))
+        self.netatmo.token_store.save(self.access_token, self.expires_at, self.refresh_token)
+        logger.info("Refreshed oauth access token")
+
+    def set_scheduler(self, scheduler):
+        # APScheduler shared by the accounts of the process, runs the proactive refreshes
+        self.scheduler = scheduler
+        if self.access_token != None:
+            self.schedule_refresh()
+
+    def schedule_refresh(self, delay: float = None):
+        # Without a scheduler (one-shot commands) get_token renews the token when needed
+        if self.scheduler == None:
+            return
+        if delay == None:
+            delay = max(self.expires_at - self.refresh_margin - time.time(), 1)
+        run_date = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.scheduler.add_job(self.background_refresh, "date", run_date=run_date, id=self.job_id, replace_existing=True)
+
+    def background_refresh(self):
+        logger.info("Proactive token refresh")
+        try:
+            with self.lock:
+                self.refresh()
+        except Exception as e:
+            logger.error(f"Error refreshing token. Retry in {self.retry_delay} seconds. Exception {e}")
+            self.schedule_refresh(delay=self.retry_delay)
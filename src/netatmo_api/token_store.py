@@ -0,0 +1,163 @@
+#!/bin/python3
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import logging
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks (Windows): the store still writes atomically
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+class TokenStore():
+    """
+    Persists the credentials of one account as a small json file
+    {"access_token", "refresh_token", "expires_at"} shared by every process of the account.
+    Writes go to a temporary file renamed over the store, under an exclusive lock of
+    token_file.lock. Reads are served from memory until the file mtime changes.
+    """
+
+    def __init__(self, token_file: str):
+        self.token_file = token_file
+        self.lock_file = token_file + ".lock"
+        self.cache_lock = threading.Lock()
+        # Reentrant within the process, the file lock only excludes other processes
+        self.thread_lock = threading.RLock()
+        self.lock_depth = 0
+        self.cached_mtime = None
+        self.cached = None
+
+    def ensure_dir(self):
+        token_dir = os.path.dirname(os.path.realpath(self.token_file))
+        if not os.path.exists(token_dir):
+            logger.info(f"Creating {token_dir}")
+            os.makedirs(token_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Held around a whole renewal so that other threads and processes wait for its result instead of logging in too
+        with self.thread_lock:
+            if fcntl == None or self.lock_depth > 0:
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+            self.ensure_dir()
+            with open(self.lock_file, "a") as my_file:
+                fcntl.flock(my_file, fcntl.LOCK_EX)
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                    fcntl.flock(my_file, fcntl.LOCK_UN)
+
+    def load(self):
+        try:
+            stat = os.stat(self.token_file)
+        except FileNotFoundError:
+            with self.cache_lock:
+                self.cached_mtime = None
+                self.cached = None
+            return None
+        # Every save renames a new file over the store, the inode changes even within the mtime resolution
+        mtime = (stat.st_mtime_ns, stat.st_ino)
+        with self.cache_lock:
+            if mtime == self.cached_mtime:
+                return self.cached
+        # No lock needed to read, the store is always replaced as a whole
+        try:
+            with open(self.token_file) as my_file:
+                credentials = json.load(my_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning(f"Ignoring corrupted token store {self.token_file}")
+            return None
+        with self.cache_lock:
+            self.cached_mtime = mtime
+            self.cached = credentials
+        return credentials
+
+    def get_fresh(self, margin: float = 0):
+        # Stored credentials when the access token is still valid for margin seconds
+        credentials = self.load()
+        if credentials == None or credentials.get("access_token") == None:
+            return None
+        if time.time() >= credentials.get("expires_at", 0) - margin:
+            return None
+        return credentials
+
+    def save(self, access_token: str, expires_at: float, refresh_token: str = None):
+        # Call inside locked() when the write concludes a login
+        if refresh_token == None:
+            stored = self.load()
+            if stored != None:
+                refresh_token = stored.get("refresh_token")
+        credentials = {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_at": expires_at
+        }
+        self.ensure_dir()
+        temp_file = f"{self.token_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, "w") as my_file:
+            os.chmod(temp_file, 0o600)
+            json.dump(credentials, my_file, separators=(",", ":"))
+            my_file.flush()
+            os.fsync(my_file.fileno())
+        os.replace(temp_file, self.token_file)
+        logger.info(f"Persisted token at {self.token_file}")
+        return credentials
+
+    def clear(self, access_token: str = None):
+        # With access_token, only while the store still holds that (rejected) token
+        with self.locked():
+            stored = self.load()
+            if stored == None:
+                return
+            if access_token != None and stored.get("access_token") != access_token:
+                return
+            if stored.get("refresh_token") != None:
+                # The refresh token stays usable after its access token expired
+                self.save(None, 0, stored["refresh_token"])
+            else:
+                os.remove(self.token_file)
+            logger.info(f"Cleared token at {self.token_file}")
+
+# Default location of the stores, shared by Netatmo_API and NetatmoAuth so that both find the token of a user
+default_token_dir = os.path.realpath(os.path.dirname(__file__)) + "/tmp"
+
+token_stores = {}
+token_stores_lock = threading.Lock()
+
+def get_default_token_file(username: str, token_dir: str = None):
+    # One store per account, accounts must not overwrite each other tokens
+    if token_dir == None:
+        token_dir = default_token_dir
+    return os.path.join(token_dir, "token_" + re.sub(r"[^\w.@-]", "_", username) + ".json")
+
+def get_token_store(token_file: str):
+    # One store per file, shared by every instance of the account in the process
+    token_file = os.path.realpath(token_file)
+    with token_stores_lock:
+        if token_file not in token_stores:
+            token_stores[token_file] = TokenStore(token_file)
+        return token_stores[token_file]
@@ -0,0 +1 @@
+from .generator import OpenhabGenerator
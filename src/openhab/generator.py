@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import os
+import threading
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+# Default templates, found relative to the sources instead of the working directory
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "templates")
+
+environments = {}
+environments_lock = threading.Lock()
+
+def get_environment(templates_dir: str):
+    # One jinja environment per templates directory, templates are compiled on first use and kept
+    from jinja2 import Environment, FileSystemLoader
+    with environments_lock:
+        if templates_dir not in environments:
+            environments[templates_dir] = Environment(loader=FileSystemLoader(templates_dir), auto_reload=False)
+        return environments[templates_dir]
+
+class OpenhabGenerator():
+    """
+    Renders the openhab things, items and sitemap of the polled homes. A file is
+    replaced (atomically, through a temporary file) only when its content changed,
+    so running it after every poll does not make openhab reload its configuration.
+    """
+
+    # mode -> (template, openhab directory, extension)
+    files = {
+        "things": ("template_things.j2", "things", "things"),
+        "items": ("template_items.j2", "items", "items"),
+        "sitemaps": ("template_sitemaps.j2", "sitemaps", "sitemap")
+    }
+    openhab_basedir = "/etc/openhab"
+    templates_dir = TEMPLATES_DIR
+    # File names (and sitemap name) are <name>.<extension>
+    name = "netatmo"
+
+    def __init__(self, openhab_basedir: str = None, templates_dir: str = None, name: str = None):
+        if openhab_basedir != None:
+            self.openhab_basedir = openhab_basedir.rstrip("/")
+        if templates_dir != None:
+            self.templates_dir = templates_dir
+        if name != None:
+            self.name = name
+        self.environment = get_environment(self.templates_dir)
+        # target file -> sha1 of its content, known after the first write or read
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def get_context(self, all_data: dict):
+        # Rooms and modules grouped per home once, instead of filtering the whole list in every home loop
+        context = dict(all_data)
+        rooms_by_home = {}
+        modules_by_home = {}
+        for room in all_data.get("rooms", []):
+            rooms_by_home.setdefault(room.get("home_id"), []).append(room)
+        for module in all_data.get("modules", []):
+            modules_by_home.setdefault(module.get("home_id"), []).append(module)
+        context["rooms_by_home"] = rooms_by_home
+        context["modules_by_home"] = modules_by_home
+        context["sitemap_name"] = self.name
+        return context
+
+    def render(self, all_data: dict):
+        context = self.get_context(all_data)
+        rendered = {}
+        for mode, (template_file, directory, extension) in self.files.items():
+            rendered[mode] = self.environment.get_template(template_file).render(context)
+        return rendered
+
+    def get_target_file(self, mode: str):
+        template_file, directory, extension = self.files[mode]
+        return os.path.join(self.openhab_basedir, directory, f"{self.name}.{extension}")
+
+    def get_file_hash(self, target_file: str):
+        if target_file not in self.hashes:
+            if not os.path.exists(target_file):
+                return None
+            with open(target_file, "rb") as my_file:
+                self.hashes[target_file] = hashlib.sha1(my_file.read()).hexdigest()
+        return self.hashes[target_file]
+
+    def write(self, mode: str, data: str):
+        # True when the file was replaced, False when unchanged or the openhab directory is missing
+        target_file = self.get_target_file(mode)
+        target_dir = os.path.dirname(target_file)
+        if not os.path.exists(target_dir):
+            logger.error(f"openhab basedir {target_dir} is not present ")
+            return False
+        content = data.encode("utf-8")
+        content_hash = hashlib.sha1(content).hexdigest()
+        with self.lock:
+            if self.get_file_hash(target_file) == content_hash:
+                logger.debug(f"Unchanged {target_file}")
+                return False
+            temp_file = f"{target_file}.{os.getpid()}.tmp"
+            with open(temp_file, "wb") as my_file:
+                my_file.write(content)
+            os.replace(temp_file, target_file)
+            self.hashes[target_file] = content_hash
+        logger.info(f"Created {target_file}")
+        return True
+
+    def generate(self, all_data: dict):
+        """
+        Renders and writes every file. Returns mode -> rendered content and the list
+        of modes whose file changed.
+        """
+        rendered = self.render(all_data)
+        changed = [mode for mode, data in rendered.items() if self.write(mode, data)]
+        return rendered, changed
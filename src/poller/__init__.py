@@ -0,0 +1,2 @@
+from .adaptive import AdaptiveInterval
+from .snapshot import StateSnapshot
\ No newline at end of file
@@ -0,0 +1,97 @@
+import threading
+import time
+import os
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+ENVIRONMENT = os.environ.get("ENVIRONMENT", "prod").lower()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+logging_formatter = logging.Formatter(
+    '%(levelname)-8s [%(filename)s:%(lineno)d] (' + ENVIRONMENT + ') - %(message)s')
+stream_handler.setFormatter(logging_formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+class AdaptiveInterval():
+    """
+    Decides the delay (seconds) until the next poll:
+    - min_interval during boost_duration seconds after a command or a detected change
+    - stretched by stretch_factor up to max_interval while polls see no change
+    - exponential backoff up to max_interval on errors, straight to max_interval when rate limited
+    """
+
+    boost_duration = 600
+    stable_polls = 3
+    stretch_factor = 1.5
+    backoff_factor = 2
+
+    def __init__(self, interval: float, min_interval: float = None, max_interval: float = None, boost_duration: float = None):
+        self.base_interval = float(interval)
+        if min_interval == None:
+            min_interval = self.base_interval
+        if max_interval == None:
+            max_interval = self.base_interval
+        self.min_interval = min(float(min_interval), self.base_interval)
+        self.max_interval = max(float(max_interval), self.base_interval)
+        if boost_duration != None:
+            self.boost_duration = float(boost_duration)
+        self.interval = self.base_interval
+        self.boost_until = 0
+        self.unchanged_polls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def get_interval(self):
+        return self.interval
+
+    def boost(self):
+        self.boost_until = time.time() + self.boost_duration
+        self.unchanged_polls = 0
+        self.interval = self.min_interval
+
+    def on_command(self):
+        with self.lock:
+            self.boost()
+            return self.interval
+
+    def on_success(self, changed: bool = False):
+        with self.lock:
+            self.errors = 0
+            if changed == True:
+                self.boost()
+            elif time.time() < self.boost_until:
+                self.interval = self.min_interval
+            else:
+                self.unchanged_polls += 1
+                if self.unchanged_polls > self.stable_polls:
+                    self.interval = min(max(self.interval, self.base_interval) * self.stretch_factor, self.max_interval)
+                else:
+                    self.interval = self.base_interval
+            return self.interval
+
+    def on_error(self, rate_limited: bool = False):
+        with self.lock:
+            self.errors += 1
+            self.unchanged_polls = 0
+            if rate_limited == True:
+                self.interval = self.max_interval
+            else:
+                backoff = self.base_interval * (self.backoff_factor ** self.errors)
+                self.interval = min(backoff, self.max_interval)
+            logger.warning(f"Poll error number {self.errors} rate_limited={rate_limited}. Next poll in {self.interval} seconds")
+            return self.interval
+
+    def get_stats(self):
+        stats = {
+            "interval": self.interval,
+            "base_interval": self.base_interval,
+            "min_interval": self.min_interval,
+            "max_interval": self.max_interval,
+            "boost_remaining": max(self.boost_until - time.time(), 0),
+            "unchanged_polls": self.unchanged_polls,
+            "errors": self.errors
+        }
+        return stats
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import threading
+
+
+class StateSnapshot():
+    """
+    Serialized copy of the last polled state. The json bytes and their ETag are
+    built once per poll, readers only pick the current snapshot and never
+    serialize anything nor call Netatmo.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+        self.updates = 0
+
+    def serialize(self, payload):
+        content = json.dumps(payload, separators=(",", ":"), default=str).encode()
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        return content, etag
+
+    def update(self, all_data: dict):
+        state = {
+            "homes": all_data["homes"],
+            "rooms": all_data["rooms"],
+            "modules": all_data["modules"]
+        }
+        content, etag = self.serialize(state)
+        if self.current != None and self.current["etag"] == etag:
+            return False
+        snapshot = {
+            "state": content,
+            "etag": etag,
+            "rooms": {room["id"]: self.serialize(room) for room in all_data["rooms"]},
+            "modules": {module["id"]: self.serialize(module) for module in all_data["modules"]}
+        }
+        # Readers see either the previous snapshot or the new one, never a mix
+        with self.lock:
+            self.current = snapshot
+            self.updates += 1
+        return True
+
+    def get_state(self):
+        # (content, etag) or None before the first poll
+        snapshot = self.current
+        if snapshot == None:
+            return None
+        return snapshot["state"], snapshot["etag"]
+
+    def get_entity(self, kind: str, entity_id: str):
+        snapshot = self.current
+        if snapshot == None:
+            return None
+        return snapshot[kind].get(entity_id)
@@ -1,7 +1,11 @@
 from typing import Optional
-from fastapi import FastAPI
-from starlette.responses import RedirectResponse
+from fastapi import FastAPI, Header, HTTPException, Query
+from starlette.responses import RedirectResponse, Response
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+from metrics import get_metrics
 import uvicorn
 import logging
 import os
@@ -37,6 +41,58 @@ fastapi_parameters = {
 
 app = FastAPI(**fastapi_parameters)
 
+# Netatmo commands are blocking http calls: they run on a bounded pool, never on the event loop
+command_workers = 4
+command_timeout = 30
+
+def get_command_executor():
+    if getattr(app.state, "command_executor", None) == None:
+        app_config = getattr(app.state, "config", {})
+        workers = int(app_config.get("command_workers", command_workers))
+        app.state.command_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="web_command")
+        # At most one command per worker is accepted, the others are rejected instead of queued
+        app.state.command_slots = threading.BoundedSemaphore(workers)
+        app.state.command_timeout = float(app_config.get("command_timeout", command_timeout))
+    return app.state.command_executor
+
+async def run_command(function, *args, **kwargs):
+    executor = get_command_executor()
+    if app.state.command_slots.acquire(blocking=False) == False:
+        raise HTTPException(status_code=503, detail="Too many netatmo commands in flight", headers={"Retry-After": "5"})
+    try:
+        future = executor.submit(function, *args, **kwargs)
+    except Exception:
+        app.state.command_slots.release()
+        raise
+    # The slot is freed when netatmo answers, even if the client gave up waiting
+    future.add_done_callback(lambda done: app.state.command_slots.release())
+    try:
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=app.state.command_timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Timeout waiting for the netatmo command")
+
+def get_instance(account: str = None):
+    # The default instance, or one account of a multi account daemon
+    app_config = app.state.config
+    if account == None:
+        return app_config["instance"]
+    accounts = app_config.get("accounts", {})
+    if account not in accounts:
+        raise HTTPException(status_code=404, detail=f"Unknown account {account}")
+    return accounts[account]
+
+def snapshot_response(snapshot, if_none_match: str = None):
+    # snapshot is (json bytes, etag) from the state snapshot, served as is
+    if snapshot == None:
+        raise HTTPException(status_code=404, detail="Not found")
+    content, etag = snapshot
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match != None:
+        etags = [value.strip().replace("W/", "", 1) for value in if_none_match.split(",")]
+        if etag in etags or "*" in etags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
 class SetThermMode(str, Enum):
     schedule = "schedule"
     away = "away"
@@ -48,44 +104,135 @@ class MqttMode(str, Enum):
     both = "both"
 
 @app.put("/setthermode")
-async def put_seththermode(mode: SetThermMode):
+async def put_seththermode(mode: SetThermMode, account: Optional[str] = None):
     settherm_mode = mode.value
     app_config = app.state.config
-    netatmo = app_config["instance"]
+    netatmo = get_instance(account)
     config = app_config["config"]
-    response = netatmo.setthermmode(mode=settherm_mode)
+    response = await run_command(netatmo.setthermmode, mode=settherm_mode)
     return response
 
 @app.put("/truetemperature/{room_id}")
-async def put_truetemperature(room_id: str, corrected_temperature: float):
+async def put_truetemperature(room_id: str, corrected_temperature: float, account: Optional[str] = None):
     app_config = app.state.config
-    netatmo = app_config["instance"]
+    netatmo = get_instance(account)
     config = app_config["config"]
-    response = netatmo.truetemperature(room_id, corrected_temperature)
+    response = await run_command(netatmo.truetemperature, room_id, corrected_temperature)
     return response
 
+@app.get("/accounts")
+async def get_accounts():
+    app_config = app.state.config
+    accounts = app_config.get("accounts", {})
+    payload = {name: netatmo.get_scheduler_status() for name, netatmo in accounts.items()}
+    return payload
+
+@app.get("/scheduler")
+async def get_scheduler(account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    payload = netatmo.get_scheduler_status()
+    return payload
+
+@app.get("/commands")
+async def get_commands(account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    payload = netatmo.get_command_status()
+    return payload
+
+@app.get("/governor")
+async def get_governor(account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    payload = netatmo.get_governor_status()
+    return payload
+
+@app.put("/topology/invalidate")
+async def put_topology_invalidate(account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    netatmo.invalidate_topology()
+    return {"status": "ok"}
+
+@app.get("/state")
+async def get_state(if_none_match: Optional[str] = Header(None), account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    snapshot = netatmo.state_snapshot.get_state()
+    if snapshot == None:
+        raise HTTPException(status_code=503, detail="No netatmo state polled yet")
+    return snapshot_response(snapshot, if_none_match)
+
+@app.get("/state/rooms/{room_id}")
+async def get_state_room(room_id: str, if_none_match: Optional[str] = Header(None), account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    snapshot = netatmo.state_snapshot.get_entity("rooms", room_id)
+    return snapshot_response(snapshot, if_none_match)
+
+@app.get("/state/modules/{module_id}")
+async def get_state_module(module_id: str, if_none_match: Optional[str] = Header(None), account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    snapshot = netatmo.state_snapshot.get_entity("modules", module_id)
+    return snapshot_response(snapshot, if_none_match)
+
+class MeasureScale(str, Enum):
+    min30 = "30min"
+    hour1 = "1hour"
+    hours3 = "3hours"
+    day1 = "1day"
+    week1 = "1week"
+    month1 = "1month"
+
+@app.get("/roommeasure/{room_id}")
+def get_roommeasure(room_id: str, scale: Optional[MeasureScale] = MeasureScale.min30, measure_type: Optional[str] = "temperature",
+                    date_begin: Optional[int] = None, date_end: Optional[int] = None, account: Optional[str] = None):
+    # Plain def: a backfill can take long, it runs on the FastAPI thread pool
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    payload = netatmo.getroommeasure(room_id, scale=scale.value, types=measure_type.split(","), date_begin=date_begin, date_end=date_end)
+    return payload
+
+class HistoryResolution(str, Enum):
+    auto = "auto"
+    raw = "raw"
+    minute = "1m"
+    hour = "1h"
+    day = "1d"
+
+@app.get("/history/{entity_id}")
+def get_history(entity_id: str, start: Optional[float] = None, end: Optional[float] = None,
+                resolution: Optional[HistoryResolution] = HistoryResolution.auto, field: Optional[str] = None, account: Optional[str] = None):
+    # Plain def: sqlite reads run on the FastAPI thread pool, not on the event loop
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    payload = netatmo.get_history(entity_id, start=start, end=end, resolution=resolution.value, field=field)
+    if payload == None:
+        raise HTTPException(status_code=404, detail="History is disabled, see [history] enabled")
+    return payload
+
 @app.get("/mqtt")
-async def get_mqtt(mode: Optional[MqttMode] = MqttMode.both): 
+async def get_mqtt(mode: Optional[MqttMode] = MqttMode.both, item: Optional[str] = None, since: Optional[float] = None,
+                   limit: int = Query(100, ge=1, le=1000), cursor: Optional[int] = None, account: Optional[str] = None):
+    app_config = app.state.config
+    netatmo = get_instance(account)
+    payload = netatmo.get_mqtt_events(mode=mode.value, item=item, since=since, limit=limit, cursor=cursor)
+    return payload
+
+@app.get("/mqtt/stats")
+async def get_mqtt_stats():
     app_config = app.state.config
     netatmo = app_config["instance"]
-    config = app_config["config"]
-    if mode == MqttMode.outbound:
-        payload = {
-        "mqtt_receive_queue": [],
-        "mqtt_send_queue": netatmo.mqtt_sent_queue
-        }
-    elif mode == MqttMode.inbound:
-        payload = {
-        "mqtt_receive_queue": netatmo.mqtt_receive_queue,
-        "mqtt_send_queue": []
-        }
-    else:
-        payload = {
-        "mqtt_receive_queue": netatmo.mqtt_receive_queue,
-        "mqtt_send_queue": netatmo.mqtt_sent_queue
-        }
+    payload = netatmo.get_mqtt().get_stats()
     return payload
 
+@app.get("/metrics")
+async def get_prometheus_metrics():
+    content, content_type = get_metrics()
+    return Response(content=content, media_type=content_type)
+
 @app.get("/")
 async def redirect_docs():
     # return {"Hello": "World"}